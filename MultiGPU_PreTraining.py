@@ -1,29 +1,68 @@
 import matplotlib.pyplot as plt
+import argparse
+import contextlib
+import itertools
 import os
 import torch
 import urllib.request
 import tiktoken
 import os
 import time 
-import math 
+import math
+import numpy as np 
 
 import tiktoken
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import Dataset, DataLoader
+from prepare_data import (MemmapTokenDataset, PackedTokenDataset, Prefetcher, ResumableDistributedSampler,
+                          ResumableLoaderIterator, StreamingTextDataset, TokenStream,
+                          cached_token_shards, list_shards)
+from attention import attention
+from checkpointing import (AsyncCheckpointer, embeddings_tied, load_checkpoint_file, merge_optimizer_shards,
+                           optimizer_shard, tie_embedding_weights)
 
 import torch.multiprocessing as mp
-from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+from tensor_parallel import clip_grad_norm_ as tensor_parallel_clip_grad_norm_
+from tensor_parallel import gather_state_dict, init_groups, shard_state_dict, tensor_parallel
+from pipeline import PipelineModel
 from torch.distributed import init_process_group , destroy_process_group
 import torch.distributed as dist
 
-def ddp_setup(rank,world_size):
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = "12355"
-    # init_process_group(backend="nccl", init_method="env://", rank=rank, world_size=world_size)
-    init_process_group(backend="nccl",rank=rank,world_size=world_size)
-    
+def ddp_setup(backend="auto"):
+    # Rank, world size and rendezvous come from the environment: RANK, LOCAL_RANK, WORLD_SIZE,
+    # MASTER_ADDR and MASTER_PORT, set by torchrun or by spawn_worker below.
+    # Returns (rank, world_size, device), one GPU per local rank or the CPU when there is none
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ["LOCAL_RANK"])
+    world_size = int(os.environ["WORLD_SIZE"])
+    if backend == "auto":
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if torch.cuda.is_available():
+        device = torch.device(f'cuda:{local_rank}')
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device("cpu")
+        if "OMP_NUM_THREADS" not in os.environ:
+            # Split the cores between the processes of this node
+            torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get("LOCAL_WORLD_SIZE", 1))))
+    init_process_group(backend=backend, init_method="env://", rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+
+def spawn_worker(local_rank, lock, gpt_config, settings):
+    # Entry point of the processes started by mp.spawn, sets the variables torchrun would set
+    node_rank = int(os.environ["GROUP_RANK"])
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["RANK"] = str(node_rank * int(os.environ["LOCAL_WORLD_SIZE"]) + local_rank)
+    main(lock, gpt_config, settings)
+
+
+
 class GPTDatasetV1(Dataset):
     def __init__(self, txt, tokenizer, max_length, stride):
         self.input_ids = []
@@ -47,24 +86,63 @@ class GPTDatasetV1(Dataset):
 
 
 def create_dataloader_v1(txt, batch_size=4, max_length=256,
-                         stride=128, shuffle=True, drop_last=True, num_workers=0):
+                         stride=128, shuffle=True, drop_last=True, num_workers=0, packing=False, group=None):
+    # group: data parallel process group the rows are split over, all ranks by default
     # Initialize the tokenizer
     tokenizer = tiktoken.get_encoding("gpt2")
 
     # Create dataset
-    dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
+    if packing:
+        # Rows of whole documents with document ids instead of a sliding window, stride is unused
+        token_ids = tokenizer.encode(txt, allowed_special={"<|endoftext|>"})
+        dataset = PackedTokenDataset(np.asarray(token_ids), max_length)
+    else:
+        dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
 
     # Create dataloader
     dataloader = DataLoader(
         dataset, batch_size=batch_size, shuffle=False, drop_last=drop_last, num_workers=num_workers,
-        pin_memory=True,sampler=DistributedSampler(dataset,shuffle=shuffle))
+        pin_memory=torch.cuda.is_available(),sampler=ResumableDistributedSampler(dataset,num_replicas=dist.get_world_size(group),rank=dist.get_rank(group),shuffle=shuffle),
+        # Iterators are created in the prefetch thread, their worker seeds must not come from the global RNG
+        generator=torch.Generator().manual_seed(123))
+
+    return dataloader
+
+
+def create_dataloader_from_shards(data_dir, split, batch_size=4, max_length=256,
+                                  stride=128, shuffle=True, drop_last=True, num_workers=0, packing=False, group=None):
+    # Token shards written by prepare_data.py, windows are sliced lazily from a memmap
+    if packing:
+        dataset = PackedTokenDataset(TokenStream(data_dir, split), max_length)
+    else:
+        dataset = MemmapTokenDataset(data_dir, split, max_length, stride)
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=False, drop_last=drop_last, num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),sampler=ResumableDistributedSampler(dataset,num_replicas=dist.get_world_size(group),rank=dist.get_rank(group),shuffle=shuffle),
+        # Iterators are created in the prefetch thread, their worker seeds must not come from the global RNG
+        generator=torch.Generator().manual_seed(123))
+
+    return dataloader
+
+
+def create_dataloader_streaming(file_path, split, batch_size=4, max_length=256,
+                                stride=128, drop_last=True, num_workers=0, group=None):
+    # Reads and tokenizes the text file on the fly, for corpora that do not fit in memory.
+    # Documents are split into train/val by StreamingTextDataset and sharded over the ranks
+    dataset = StreamingTextDataset(file_path, split, max_length, stride, batch_size=batch_size,
+                                   num_workers=num_workers, rank=dist.get_rank(group), world_size=dist.get_world_size(group))
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, drop_last=drop_last, num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+        generator=torch.Generator().manual_seed(123))
 
     return dataloader
 
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_in, d_out, num_heads, context_length, dropout=0.0, qkv_bias=False):
+    def __init__(self, d_in, d_out, num_heads, context_length, dropout=0.0, qkv_bias=False, backend="sdpa"):
         super().__init__()
 
         assert d_out % num_heads == 0, "embed_dim is indivisible by num_heads"
@@ -77,8 +155,9 @@ class MultiHeadAttention(nn.Module):
         self.qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
         self.proj = nn.Linear(d_out, d_out)
         self.dropout = dropout
+        self.backend = backend   # See attention.py
 
-    def forward(self, x):
+    def forward(self, x, attn_mask=None):
         batch_size, num_tokens, embed_dim = x.shape
 
         # (b, num_tokens, embed_dim) --> (b, num_tokens, 3 * embed_dim)
@@ -95,8 +174,9 @@ class MultiHeadAttention(nn.Module):
 
         use_dropout = 0. if not self.training else self.dropout
 
-        context_vec = nn.functional.scaled_dot_product_attention(
-            queries, keys, values, attn_mask=None, dropout_p=use_dropout, is_causal=True)
+        # attn_mask: block diagonal causal mask of packed rows, plain causal attention without it
+        context_vec = attention(queries, keys, values, attn_mask=attn_mask, dropout_p=use_dropout,
+                                is_causal=attn_mask is None, backend=self.backend)
 
         # Combine heads, where self.d_out = self.num_heads * self.head_dim
         context_vec = context_vec.transpose(1, 2).contiguous().view(batch_size, num_tokens, self.d_out)
@@ -115,10 +195,8 @@ class LayerNorm(nn.Module):
         self.shift = nn.Parameter(torch.zeros(emb_dim))
 
     def forward(self, x):
-        mean = x.mean(dim=-1, keepdim=True)
-        var = x.var(dim=-1, keepdim=True, unbiased=False)
-        norm_x = (x - mean) / torch.sqrt(var + self.eps)
-        return self.scale * norm_x + self.shift
+        # Single fused kernel, same as (x - mean) / sqrt(var + eps) * scale + shift
+        return nn.functional.layer_norm(x, self.scale.shape, self.scale, self.shift, self.eps)
 
 
 class GELU(nn.Module):
@@ -126,10 +204,8 @@ class GELU(nn.Module):
         super().__init__()
 
     def forward(self, x):
-        return 0.5 * x * (1 + torch.tanh(
-            torch.sqrt(torch.tensor(2.0 / torch.pi)) *
-            (x + 0.044715 * torch.pow(x, 3))
-        ))
+        # Fused tanh approximation: 0.5 * x * (1 + tanh(sqrt(2 / pi) * (x + 0.044715 * x^3)))
+        return nn.functional.gelu(x, approximate="tanh")
 
 
 class FeedForward(nn.Module):
@@ -154,17 +230,18 @@ class TransformerBlock(nn.Module):
             context_length=cfg["context_length"],
             num_heads=cfg["n_heads"],
             dropout=cfg["drop_rate"],
-            qkv_bias=cfg["qkv_bias"])
+            qkv_bias=cfg["qkv_bias"],
+            backend=cfg.get("attn_backend", "sdpa"))
         self.ff = FeedForward(cfg)
         self.norm1 = LayerNorm(cfg["emb_dim"])
         self.norm2 = LayerNorm(cfg["emb_dim"])
         self.drop_shortcut = nn.Dropout(cfg["drop_rate"])
 
-    def forward(self, x):
+    def forward(self, x, attn_mask=None):
         # Shortcut connection for attention block
         shortcut = x
         x = self.norm1(x)
-        x = self.att(x)   # Shape [batch_size, num_tokens, emb_size]
+        x = self.att(x, attn_mask)   # Shape [batch_size, num_tokens, emb_size]
         x = self.drop_shortcut(x)
         x = x + shortcut  # Add the original input back
 
@@ -178,6 +255,20 @@ class TransformerBlock(nn.Module):
         return x
 
 
+def document_positions_and_mask(doc_ids):
+    # doc_ids: (b, num_tokens) document of every token of a packed row, see PackedTokenDataset.
+    # Returns the position of every token inside its document and the block diagonal causal
+    # mask (b, 1, num_tokens, num_tokens): a token only attends to earlier tokens of its document
+    idx = torch.arange(doc_ids.shape[1], device=doc_ids.device)
+    is_start = torch.ones_like(doc_ids, dtype=torch.bool)
+    is_start[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    starts = torch.cummax(torch.where(is_start, idx, 0), dim=1).values
+    positions = idx - starts
+    same_doc = doc_ids.unsqueeze(2) == doc_ids.unsqueeze(1)
+    causal = idx.view(-1, 1) >= idx.view(1, -1)
+    return positions, (same_doc & causal).unsqueeze(1)
+
+
 class GPTModel(nn.Module):
     def __init__(self, cfg):
         super().__init__()
@@ -190,18 +281,73 @@ class GPTModel(nn.Module):
 
         self.final_norm = LayerNorm(cfg["emb_dim"])
         self.out_head = nn.Linear(cfg["emb_dim"], cfg["vocab_size"], bias=False)
+        if cfg.get("tie_embeddings", False):
+            # Both are (vocab_size, emb_dim), one parameter serves as embedding and output projection
+            self.out_head.weight = self.tok_emb.weight
+
+        # Activations of every k-th block are recomputed in backward instead of stored
+        self.checkpoint_every = cfg.get("activation_checkpointing", 0)
+        # The training loss computes the logits this many positions at a time
+        self.loss_chunk_size = cfg.get("loss_chunk_size", 0)
+        self.context_length = cfg["context_length"]
+
+    def run_blocks(self, x, attn_mask=None):
+        checkpointing = self.checkpoint_every and self.training and torch.is_grad_enabled()
+        for i, block in enumerate(self.trf_blocks):
+            if checkpointing and i % self.checkpoint_every == 0:
+                x = checkpoint(block, x, attn_mask, use_reentrant=False)
+            else:
+                x = block(x, attn_mask)
+        return x
+
+    # forward = embed -> run_blocks -> head, the stages of a pipeline (pipeline.py) run a part of it
+    def positions_and_mask(self, in_idx, doc_ids=None):
+        # doc_ids: document of every token for packed rows (PackedTokenDataset)
+        if doc_ids is not None:
+            # Positions restart at every document and attention stays inside it
+            return document_positions_and_mask(doc_ids)
+        return torch.arange(in_idx.shape[1], device=in_idx.device), None
+
+    def embed(self, in_idx, positions):
+        x = self.tok_emb(in_idx) + self.pos_emb(positions)  # Shape [batch_size, num_tokens, emb_size]
+        return self.drop_emb(x)
 
-    def forward(self, in_idx):
-        batch_size, seq_len = in_idx.shape
-        tok_embeds = self.tok_emb(in_idx)
-        pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
-        x = tok_embeds + pos_embeds  # Shape [batch_size, num_tokens, emb_size]
-        x = self.drop_emb(x)
-        x = self.trf_blocks(x)
+    def head(self, x, targets=None, last_only=False):
         x = self.final_norm(x)
+        if targets is not None:
+            return self.loss(x, targets)
+        if last_only:
+            # Generation only needs the logits of the last position
+            x = x[:, -1:, :]
         logits = self.out_head(x)
         return logits
 
+    def forward(self, in_idx, targets=None, last_only=False, doc_ids=None):
+        positions, attn_mask = self.positions_and_mask(in_idx, doc_ids)
+        x = self.embed(in_idx, positions)
+        x = self.run_blocks(x, attn_mask)
+        return self.head(x, targets, last_only)
+
+    def loss(self, x, targets):
+        # Mean cross entropy (in fp32) of out_head(x) against targets
+        if not self.loss_chunk_size:
+            logits = self.out_head(x)
+            return nn.functional.cross_entropy(logits.flatten(0, 1).float(), targets.flatten())
+
+        x = x.flatten(0, 1)
+        targets = targets.flatten()
+        total_loss = 0.
+        for start in range(0, x.shape[0], self.loss_chunk_size):
+            end = start + self.loss_chunk_size
+            total_loss = total_loss + checkpoint(self.chunk_loss, x[start:end], targets[start:end], use_reentrant=False)
+        return total_loss / (targets != -100).sum()
+
+    def chunk_loss(self, x, targets):
+        # Under checkpoint the logits of a chunk are freed after the forward pass and
+        # recomputed one chunk at a time in backward, so they never exist for all positions
+        logits = self.out_head(x)
+        return nn.functional.cross_entropy(logits.float(), targets, reduction="sum")
+
 
 def generate_text_simple(model, idx, max_new_tokens, context_size):
     # idx is (B, T) array of indices in the current context
@@ -214,7 +360,7 @@ def generate_text_simple(model, idx, max_new_tokens, context_size):
 
         # Get the predictions
         with torch.no_grad():
-            logits = model(idx_cond)
+            logits = model(idx_cond, last_only=True)
 
         # Focus only on the last time step
         # (batch, n_token, vocab_size) becomes (batch, vocab_size)
@@ -239,14 +385,25 @@ def token_ids_to_text(token_ids, tokenizer):
     return tokenizer.decode(flat.tolist())
 
 
-def calc_loss_batch(input_batch, target_batch, model, device):
+def autocast_context(device, precision):
+    # bf16 has the fp32 exponent range, so mixed precision needs no loss scaling: only the
+    # forward pass runs under autocast, parameters and optimizer state stay in fp32
+    assert precision in ("fp32", "bf16"), f"unknown precision {precision}"
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+def calc_loss_batch(input_batch, target_batch, model, device, precision="fp32", doc_ids=None):
+    # doc_ids: only for packed batches (PackedTokenDataset), see GPTModel.forward
     input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-    logits = model(input_batch)
-    loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), target_batch.flatten())
+    if doc_ids is not None:
+        doc_ids = doc_ids.to(device)
+    with autocast_context(device, precision):
+        # The model computes the cross entropy in fp32, in chunks when loss_chunk_size is set
+        loss = model(input_batch, targets=target_batch, doc_ids=doc_ids)
     return loss
 
 
-def calc_loss_loader(data_loader, model, device, num_batches=None):
+def calc_loss_loader(data_loader, model, device, num_batches=None, precision="fp32"):
     total_loss = 0.
     if len(data_loader) == 0:
         return float("nan")
@@ -254,20 +411,20 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
         num_batches = len(data_loader)
     else:
         num_batches = min(num_batches, len(data_loader))
-    for i, (input_batch, target_batch) in enumerate(data_loader):
+    for i, (input_batch, target_batch, *doc_ids) in enumerate(data_loader):
         if i < num_batches:
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
+            loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *doc_ids)
             total_loss += loss
         else:
             break
     return total_loss / num_batches
 
 
-def generate_and_print_sample(model, tokenizer, device, start_context):
+def generate_and_print_sample(model, tokenizer, device, start_context, precision="fp32"):
     model.eval()
-    context_size = model.module.pos_emb.weight.shape[0]
+    context_size = model.module.context_length
     encoded = text_to_token_ids(start_context, tokenizer).to(device)
-    with torch.no_grad():
+    with torch.no_grad(), autocast_context(device, precision):
         token_ids = generate_text_simple(
             model=model, idx=encoded,
             max_new_tokens=50, context_size=context_size
@@ -293,75 +450,237 @@ def get_lr(iteration,max_lr,min_lr,max_steps,warmup_steps):
     
 
 
-def save_checkpoint(model,optimizer,global_step,total_time,file_path='checkpoint.pth'):
-    print("Saving CheckPoints ...") 
-    if os.path.exists("/kaggle/working/checkpoint.pth"):
-        os.remove("/kaggle/working/checkpoint.pth")
-    
-    model.eval()
-    checkpoint = {
-        'model_state_dict': model.state_dict()   ,      # Save Model state
-        'optimizer_state_dict': optimizer.state_dict(), # Save Optimizer state
-        'step': global_step,  # Current step
-        'random_state': torch.random.get_rng_state(),  # Random state for reproducibility
-        'total_time' : total_time
-    }
-    torch.save(checkpoint, file_path)
-    print(f"Checkpoint saved at step {global_step} to {file_path}")
-    print(50*"=")
-    model.train()
+def save_checkpoint(checkpointer,model,optimizer,global_step,total_time,rank,data_state,shard_checkpointer=None,tp_group=None):
+    # Called on every rank between two optimizer steps: the tensors are copied to CPU right away
+    # and written in the background, so the ranks only wait for the copy. Rank 0 writes the
+    # checkpoint. The state of a ZeroRedundancyOptimizer is either gathered into it
+    # (consolidated) or every rank writes its own part with shard_checkpointer (sharded).
+    # With tensor or pipeline parallelism the full weights are gathered and every rank writes its optimizer state
+    model_state = model.state_dict()
+    if tp_group is not None:
+        model_state = gather_state_dict(model, model_state)
+    elif isinstance(model, PipelineModel):
+        model_state = model.gather_state_dict(model_state)   # From all stages onto rank 0
+
+    if shard_checkpointer is not None:
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            shard_checkpointer.save(optimizer_shard(optimizer), global_step)
+        else:
+            shard_checkpointer.save({'state': optimizer.state_dict()['state']}, global_step)
+        optimizer_state = {'optimizer_shards': dist.get_world_size(),   # Number of shard files
+                           'tensor_parallel': dist.get_world_size(tp_group) if tp_group is not None else 1,
+                           'pipeline_parallel': model.num_stages if isinstance(model, PipelineModel) else 1}
+    else:
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            optimizer.consolidate_state_dict(to=0)   # Collective, every rank sends its part to rank 0
+        optimizer_state = {'optimizer_state_dict': optimizer.state_dict() if rank == 0 else None}
 
-def load_checkpoint(model, optimizer, rank,file_path="checkpoint.pth"):
+    if rank == 0:
+        checkpoint = {
+            'model_state_dict': model_state   ,      # Save Model state
+            **optimizer_state,                              # Save Optimizer state
+            'step': global_step,  # Current step
+            'random_state': torch.random.get_rng_state(),  # Random state for reproducibility
+            'total_time' : total_time,
+            'data_state': data_state   # Position of the train loader (seed, epoch, offset), the same on every rank
+        }
+        checkpointer.save(checkpoint, global_step)
+
+
+def optimizer_shard_checkpointer(checkpoint_path, rank, keep_checkpoints=3, checkpoint_format="pickle"):
+    # Writes checkpoint_optimizer{rank}_000100.pth, ... next to the checkpoints of rank 0
+    root, ext = os.path.splitext(checkpoint_path)
+    return AsyncCheckpointer(f"{root}_optimizer{rank}{ext}", keep_last=keep_checkpoints,
+                             sharded=(checkpoint_format == "sharded"))
+
+
+def load_checkpoint(model, optimizer, device,file_path="checkpoint.pth",shard_path=None,tp_group=None,train_iter=None):
+    # shard_path(rank, step): file of an optimizer shard, for checkpoints with sharded optimizer state
     print("Loading CheckPoints ...")
-    map_location = {'cuda:%d' % 0: 'cuda:%d' % rank}
-    checkpoint = torch.load(file_path, map_location=map_location, weights_only=True)
+    # Loaded on the CPU, load_state_dict copies the tensors to the device of the parameters.
+    # random_state has to stay a CPU ByteTensor for set_rng_state
+    checkpoint = load_checkpoint_file(file_path, map_location="cpu")
     
     # Restore model state
-    model.load_state_dict(checkpoint['model_state_dict'])
-    # Restore optimizer state
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    state_dict = checkpoint['model_state_dict']
+    if tp_group is not None:
+        state_dict = shard_state_dict(model, state_dict)   # Checkpoints hold the full weights
+    elif isinstance(model, PipelineModel):
+        state_dict = model.stage_state_dict(state_dict)
+    # Pipeline stages are never tied, and hold at most one of the two matrices
+    if not isinstance(model, PipelineModel) and embeddings_tied(model.state_dict()) and not embeddings_tied(state_dict):
+        # Untied checkpoint for a tied model: average the two matrices, the optimizer state
+        # of the separate matrices does not fit the tied parameter and starts fresh
+        print("Tying tok_emb/out_head of an untied checkpoint, optimizer state is reset")
+        model.load_state_dict(tie_embedding_weights(state_dict))
+    else:
+        model.load_state_dict(state_dict)
+        # Restore optimizer state
+        if 'optimizer_shards' in checkpoint:
+            num_shards = checkpoint['optimizer_shards']
+            tp_size = dist.get_world_size(tp_group) if tp_group is not None else 1
+            pp_size = model.num_stages if isinstance(model, PipelineModel) else 1
+            model_parallel = tp_size > 1 or pp_size > 1
+            if (checkpoint.get('tensor_parallel', 1) != tp_size or checkpoint.get('pipeline_parallel', 1) != pp_size
+                    or (model_parallel and num_shards != dist.get_world_size())):
+                raise ValueError("The optimizer state was saved with a different model parallel layout")
+            if (isinstance(optimizer, ZeroRedundancyOptimizer) or model_parallel) and num_shards == dist.get_world_size():
+                ranks = [dist.get_rank()]   # Same partition as when it was saved, only this rank's part is needed
+            else:
+                ranks = range(num_shards)
+            shards = [load_checkpoint_file(shard_path(r, checkpoint['step']), map_location="cpu") for r in ranks]
+            optimizer.load_state_dict(merge_optimizer_shards(shards, optimizer))
+        else:
+            # Consolidated: a ZeroRedundancyOptimizer keeps the part of its rank
+            optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     
     # Restore random state
     torch.random.set_rng_state(checkpoint['random_state'])
     
     step = checkpoint['step']
     total_time = checkpoint['total_time']
+    if train_iter is not None and 'data_state' in checkpoint:
+        train_iter.load_state_dict(checkpoint['data_state'])
     print(f"Checkpoint loaded from {file_path}, resuming at step {step}")
     return step , total_time
 
 
-def evaluate(model,train_loader,val_loader,eval_iter,global_step,max_steps,start,epoch,device,rank,prev_time):
-    model.eval()
-    with torch.no_grad():
-        train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
-        val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
-        dist.reduce(train_loss, dst=0, op=dist.ReduceOp.AVG)
-        dist.reduce(val_loss, dst=0, op=dist.ReduceOp.AVG)
-        if rank == 0:
-            print(f"Ep {epoch+1} (Step {global_step:06d}): "
-                f"Train loss {train_loss.item():.3f}, Val loss {val_loss.item():.3f}")
-            end = time.time() + prev_time
-            ETA = (((end-start)/global_step)*(max_steps-global_step))/3600
-            print(f"ETA = {ETA} hours")
-    model.train()
+class Evaluator:
+    # Fixed eval set: the first eval_iter batches of the train and val loaders of this rank are
+    # taken once, kept on the device and regrouped into batches of eval_batch_size, so every
+    # evaluation sees the same tokens. Losses are summed on the device and all ranks synchronize
+    # once per evaluation with a single all_reduce.
+    def __init__(self, train_loader, val_loader, device, eval_iter, eval_batch_size, precision="fp32"):
+        self.device = device
+        self.eval_batch_size = eval_batch_size
+        self.precision = precision
+        self.batches = {"train": self.materialize(train_loader, eval_iter),
+                        "val": self.materialize(val_loader, eval_iter)}
+
+    def materialize(self, data_loader, num_batches):
+        samples = list(itertools.islice(data_loader, num_batches))
+        if not samples:
+            return []
+        # (input_ids, target_ids) or (input_ids, target_ids, doc_ids) for packed batches
+        columns = [torch.cat(column).to(self.device) for column in zip(*samples)]
+        return [tuple(column[i:i + self.eval_batch_size] for column in columns)
+                for i in range(0, len(columns[0]), self.eval_batch_size)]
+
+    @torch.inference_mode()
+    def losses(self, model):
+        model.eval()
+        totals = torch.zeros(4, device=self.device)   # train loss sum, train tokens, val loss sum, val tokens
+        for i, split in enumerate(("train", "val")):
+            for input_batch, target_batch, *doc_ids in self.batches[split]:
+                loss = calc_loss_batch(input_batch, target_batch, model, self.device, self.precision, *doc_ids)
+                if loss is None:
+                    continue   # Pipeline stage before the last one, the loss is counted there
+                num_targets = (target_batch != -100).sum()
+                totals[2 * i] += loss.float() * num_targets
+                totals[2 * i + 1] += num_targets
+        model.train()
+        dist.all_reduce(totals)
+        train_sum, train_tokens, val_sum, val_tokens = totals.tolist()
+        return (train_sum / train_tokens if train_tokens else float("nan"),
+                val_sum / val_tokens if val_tokens else float("nan"))
+
+
+def evaluate(evaluator,model,global_step,max_steps,start,epoch,rank,prev_time):
+    # Every rank has to call it, returns the time it took
+    eval_start = time.perf_counter()
+    train_loss, val_loss = evaluator.losses(model)
+    if rank == 0:
+        print(f"Ep {epoch+1} (Step {global_step:06d}): "
+            f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+        end = time.time() + prev_time
+        ETA = (((end-start)/global_step)*(max_steps-global_step))/3600
+        print(f"ETA = {ETA} hours")
+    return time.perf_counter() - eval_start
+
+
+class CommStats:
+    # Counts the gradient all-reduces of DDP (one per bucket) and their payload in bytes. hook is
+    # the DDP comm hook, around the plain all-reduce or the fp16/bf16 compression hook of PyTorch
+    def __init__(self, compression=None):
+        self.compression = compression
+        self.allreduce = {None: default_hooks.allreduce_hook,
+                     "fp16": default_hooks.fp16_compress_hook,
+                     "bf16": default_hooks.bf16_compress_hook}[compression]
+        self.calls = 0
+        self.bytes = 0
+
+    def hook(self, process_group, bucket):
+        buffer = bucket.buffer()
+        self.calls += 1
+        self.bytes += buffer.numel() * (2 if self.compression else buffer.element_size())
+        return self.allreduce(process_group, bucket)
+
+    def reset(self):
+        calls, num_bytes = self.calls, self.bytes
+        self.calls = self.bytes = 0
+        return calls, num_bytes
+
+
+def accumulate_gradients(model, train_iter, grad_accum_steps, device, precision="fp32"):
+    # Forward and backward of grad_accum_steps micro batches. The gradients of the first ones
+    # accumulate locally under no_sync, DDP all-reduces them once in the backward of the last one.
+    # Returns the mean loss (on the device)
+    total_loss = 0.0
+    for micro_step in range(grad_accum_steps):
+        input_batch, target_batch, *doc_ids = next(train_iter)   # Packed batches also carry the document ids
+        sync = micro_step == grad_accum_steps - 1
+        with contextlib.nullcontext() if sync else model.no_sync():
+            loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *doc_ids) / grad_accum_steps
+            loss.backward()  # Calculate loss gradients
+        total_loss += loss.detach()
+    return total_loss
 
 
 def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs,
                        eval_freq, eval_iter, start_context, tokenizer,checkpoint_step,
-                       batch_size,micro_batch_size,checkpoint_path,rank,lock):
+                       batch_size,micro_batch_size,checkpoint_path,rank,lock,precision="fp32",keep_checkpoints=3,
+                       checkpoint_format="pickle",prefetch_batches=2,eval_batch_size=None,
+                       optimizer_checkpoint="consolidated",grad_compression=None,tp_group=None):
     
     global_step = 0
     start = time.time()
     prev_time = 0
+    # checkpoint_path is the base name, the files are checkpoint_000100.pth, checkpoint_000200.pth, ...
+    # (directories checkpoint_000100/, ... with checkpoint_format="sharded").
+    # Every rank resumes from the latest one, only rank 0 writes
+    checkpointer = AsyncCheckpointer(checkpoint_path, keep_last=keep_checkpoints,
+                                     sharded=(checkpoint_format == "sharded"))
+    # With a ZeroRedundancyOptimizer and optimizer_checkpoint="sharded" every rank also writes its
+    # part of the optimizer state, nothing is gathered on rank 0. Always with tensor or pipeline
+    # parallelism, where the optimizer state of every rank belongs to its own part of the weights
+    pipelined = isinstance(model, PipelineModel)
+    shard_checkpointer = None
+    if (isinstance(optimizer, ZeroRedundancyOptimizer) and optimizer_checkpoint == "sharded") or tp_group is not None or pipelined:
+        shard_checkpointer = optimizer_shard_checkpointer(checkpoint_path, rank, keep_checkpoints, checkpoint_format)
+
+    def shard_path(shard_rank, step):
+        return optimizer_shard_checkpointer(checkpoint_path, shard_rank, checkpoint_format=checkpoint_format).path_for(step)
+
+    # Taken before the checkpoint is loaded, so a resumed run evaluates on the same batches
+    evaluator = Evaluator(train_loader, val_loader, device, eval_iter, eval_batch_size or micro_batch_size, precision)
+
+    # One iterator for the whole run, its position is saved with every checkpoint. Keeps the next
+    # batches loaded and on the device while the current micro step runs
+    train_iter = Prefetcher(ResumableLoaderIterator(train_loader), device, depth=prefetch_batches)
+
     # Load Checkpoint if exists
     try:
-        global_step , prev_time = load_checkpoint(model, optimizer,rank,checkpoint_path)
+        global_step , prev_time = load_checkpoint(model, optimizer,device,checkpointer.latest() or checkpoint_path,shard_path,
+                                                  tp_group,train_iter)
     except FileNotFoundError:
         print("No checkpoint found, starting from scratch.")
-    except :
-        print("Starting from scratch, checkpoint didn't match the current architecture")
+    except (RuntimeError, ValueError, KeyError) as e:
+        # Missing/unexpected keys or other shapes in load_state_dict, another parallel layout
+        print(f"Starting from scratch, checkpoint didn't match the current architecture: {e}")
 
     grad_accum_steps = batch_size//micro_batch_size
+    # eval_freq counts micro batches, rounded down to whole optimizer steps (evaluations run between steps)
+    eval_steps = max(1, eval_freq // grad_accum_steps)
 
     max_lr = optimizer.param_groups[0]["lr"]
     min_lr = 0.1 * max_lr
@@ -371,59 +690,94 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
     
     
     curr_epoch = global_step // per_epoch_steps
-    for _ in range(global_step%per_epoch_steps):
-        next(iter(train_loader))
 
     if rank == 0:
       print(f"Total Steps = {max_steps}")
+
+    # Counts the all-reduces of every step, optionally sending the gradients in fp16/bf16
+    comm_stats = CommStats(grad_compression)
+    if not pipelined:
+        model.register_comm_hook(model.process_group, comm_stats.hook)
+
+    step_time = 0.0
+    last_report_step = global_step
     
 
     
     # Main training loop
-    for epoch in range(num_epochs):
+    for epoch in range(curr_epoch, num_epochs):
         model.train()  # Set model to training mode
-        for i,batch in enumerate(train_loader):
-            input_batch , target_batch = batch
-
-            # Gradient Accumulation to overcome small batch size problem
-            # No synchronization during Gradient Accumulation
-            loss = calc_loss_batch(input_batch, target_batch, model, device) / grad_accum_steps
-            model.require_backward_grad_sync = ((i % grad_accum_steps) == grad_accum_steps-1)
-            loss.backward()  # Calculate loss gradients
 
+        while global_step < (epoch+1) * per_epoch_steps:
+            step_start = time.perf_counter()
 
+            # Gradient Accumulation to overcome small batch size problem
+            if pipelined:
+                # The micro batches go through the stages with the 1F1B schedule
+                model.train_step([next(train_iter) for _ in range(grad_accum_steps)], precision)
+            else:
+                accumulate_gradients(model, train_iter, grad_accum_steps, device, precision)
+
+            # Learning Rate Update 
+            lr = get_lr(global_step,max_lr,min_lr,max_steps,warmup_steps)
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
             
-            if i % grad_accum_steps == 0:
-                # Learning Rate Update 
-                lr = get_lr(global_step,max_lr,min_lr,max_steps,warmup_steps)
-                for param_group in optimizer.param_groups:
-                    param_group['lr'] = lr
-                
+            if tp_group is not None:
+                tensor_parallel_clip_grad_norm_(model.parameters(),1.0,tp_group)   # Norm of the full model
+            elif pipelined:
+                model.clip_grad_norm_(1.0)   # Norm over all stages
+            else:
                 torch.nn.utils.clip_grad_norm_(model.parameters(),1.0)   # Gradient Clipping
-                optimizer.step()  # Update model weights using loss gradients
+            optimizer.step()  # Update model weights using loss gradients
 
-                # optimizer.zero_grad()  # Reset loss gradients from previous batch iteration
-                for param in model.parameters():
-                    param.grad = None
-                    
-                global_step += 1
+            # optimizer.zero_grad()  # Reset loss gradients from previous batch iteration
+            for param in model.parameters():
+                param.grad = None
                 
+            global_step += 1
+            step_time += time.perf_counter() - step_start
 
             # Optional evaluation step
-            if  i % eval_freq == 0:
-                evaluate(model,train_loader,val_loader,eval_iter,global_step,max_steps,start,epoch,device,rank,prev_time)
+            if global_step % eval_steps == 0:
+                eval_time = evaluate(evaluator,model,global_step,max_steps,start,epoch,rank,prev_time)
+                steps = max(1, global_step - last_report_step)
+                calls, num_bytes = comm_stats.reset()
+                if pipelined:
+                    stage_times, bubble = model.stats(steps)
+                if rank == 0:
+                    # Time the loop waited for input, high values mean the data pipeline is the bottleneck
+                    print(f"Data wait {train_iter.wait_time / steps * 1000:.1f} ms/step "
+                          f"({train_iter.wait_time / max(step_time, 1e-9):.1%} of the step time), "
+                          f"eval overhead {eval_time / max(step_time, 1e-9):.1%} of the step time")
+                    if pipelined:
+                        print(f"Pipeline stages: {' / '.join(f'{t * 1000:.1f}' for t in stage_times)} ms/step forward+backward, "
+                              f"bubble {bubble:.1%} of the step time "
+                              f"(1F1B ideal {(model.num_stages - 1) / (grad_accum_steps + model.num_stages - 1):.1%})")
+                    else:
+                        print(f"Gradient all-reduce: {calls / steps:.1f} buckets, {num_bytes / steps / 1024**2:.1f} MB per step")
+                train_iter.wait_time = step_time = 0.0
+                last_report_step = global_step
 
             # Save checkpoints
-            if rank == 0 and i % checkpoint_step == 0:
+            if global_step % checkpoint_step == 0:
                 total_time = (time.time() - start) + prev_time
-                save_checkpoint(model,optimizer,global_step,total_time)
-            
-               
+                save_checkpoint(checkpointer,model,optimizer,global_step,total_time,rank,train_iter.state_dict(),
+                                shard_checkpointer,tp_group)
+
+
         # Print a sample text after each epoch
         generate_and_print_sample(
-            model, tokenizer, device, start_context
+            model, tokenizer, device, start_context, precision
         )
 
+    train_iter.close()
+    checkpointer.wait()   # Let the last checkpoint finish writing
+    if shard_checkpointer is not None:
+        shard_checkpointer.wait()
+    if rank == 0:
+        print(f"Total training stall for checkpoints: {checkpointer.total_stall:.2f}s")
+
 
 
 def plot_losses(epochs_seen, tokens_seen, train_losses, val_losses):
@@ -445,29 +799,45 @@ def plot_losses(epochs_seen, tokens_seen, train_losses, val_losses):
     # plt.show()
 
     
-def main(rank,world_size,lock,gpt_config, settings):
-    ddp_setup(rank,world_size)
-    torch.manual_seed(123)
-    device = torch.device(f'cuda:{rank}')
-    print(f"Device = {device}")
+def main(lock,gpt_config, settings):
+    rank, world_size, device = ddp_setup(settings["dist_backend"])
+    tp_group, dp_group = init_groups(settings["tensor_parallel"])
+    pp_group = None
+    if settings["pipeline_parallel"] > 1:
+        assert tp_group is None, "tensor and pipeline parallelism can't be combined"
+        pp_group, dp_group = init_groups(settings["pipeline_parallel"])   # Same layout, the groups are pipelines
+    torch.manual_seed(123)   # The same on all ranks: same initial weights, same dropout masks in a tensor parallel group
+    print(f"Rank {rank}/{world_size}, device = {device}, backend = {dist.get_backend()}")
     checkpoint_path = 'checkpoint.pth'
     ##############################
     # Download data if necessary
     ##############################
 
     file_path = "/kaggle/input/plain-text-wikipedia-simpleenglish/AllCombined.txt"
-    with open(file_path, "r", encoding="utf-8") as file:
-        text_data = file.read()
+    data_dir = settings["data_dir"]   # Token shards written by prepare_data.py
 
     ##############################
     # Initialize model
     ##############################
     
     model = GPTModel(gpt_config)
-    model.to(device)  # no assignment model = model.to(device) necessary for nn.Module classes
-    with lock:
-        model = torch.compile(model)   # compile model for efficiency
-    model = DDP(model,device_ids=[rank])
+    if tp_group is not None:
+        # Every rank keeps 1/tensor_parallel of the heads and feed-forward units of each block
+        tensor_parallel(model, tp_group)
+    if pp_group is not None:
+        # Every rank keeps the layers of its stage, the gradients are averaged by PipelineModel, not DDP
+        model = PipelineModel(model, pp_group, dp_group).to(device)
+        print(f"Rank {rank}: pipeline stage {model.stage}, trf_blocks[{model.blocks[0]}:{model.blocks[1]}]")
+        if settings["compile"]:
+            with lock or contextlib.nullcontext():
+                model.compile_stage()
+    else:
+        model.to(device)  # no assignment model = model.to(device) necessary for nn.Module classes
+        if settings["compile"]:
+            with lock or contextlib.nullcontext():
+                model = torch.compile(model)   # compile model for efficiency
+        # Gradients are averaged over the ranks that hold the same part of the model
+        model = DDP(model,device_ids=[device.index] if device.type == "cuda" else None,process_group=dp_group)
 
 
     # Define decayed and non-decayed parameters
@@ -477,38 +847,77 @@ def main(rank,world_size,lock,gpt_config, settings):
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': settings["weight_decay"]},
         {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0},
     ]
-    optimizer = torch.optim.AdamW(
-        optimizer_parameters,betas=(0.9,0.95),eps=1e-8, lr=settings["learning_rate"], 
-        weight_decay=settings["weight_decay"], foreach = True
-    )
+    if settings["zero_optimizer"]:
+        # Every rank keeps the AdamW state of 1/world_size of the parameters, updates them and
+        # broadcasts the new values
+        optimizer = ZeroRedundancyOptimizer(
+            optimizer_parameters, optimizer_class=torch.optim.AdamW, process_group=dp_group, betas=(0.9,0.95), eps=1e-8,
+            lr=settings["learning_rate"], weight_decay=settings["weight_decay"], foreach = True
+        )
+    else:
+        optimizer = torch.optim.AdamW(
+            optimizer_parameters,betas=(0.9,0.95),eps=1e-8, lr=settings["learning_rate"], 
+            weight_decay=settings["weight_decay"], foreach = True
+        )
 
     ##############################
     # Set up dataloaders
     ##############################
 
-    # Train/validation ratio
-    train_ratio = 0.90
-    split_idx = int(train_ratio * len(text_data))
-
-    train_loader = create_dataloader_v1(
-        text_data[:split_idx],
-        batch_size=settings["micro_batch_size"],
-        max_length=gpt_config["context_length"],
-        stride=gpt_config["context_length"],
-        drop_last=True,
-        shuffle=True,
-        num_workers=0
-    )
+    if not list_shards(data_dir, "train") and not settings["streaming"]:
+        # Tokenize the corpus once into the token cache, later runs (and the other ranks) reuse it
+        data_dir = cached_token_shards(file_path, settings["token_cache_dir"])
+
+    if list_shards(data_dir, "train"):
+        # Pre-tokenized corpus, nothing is loaded into memory up front
+        train_loader = create_dataloader_from_shards(
+            data_dir, "train",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=True,
+            shuffle=True,
+            num_workers=settings["num_workers"],
+            packing=settings["packing"],
+            group=dp_group
+        )
 
-    val_loader = create_dataloader_v1(
-        text_data[split_idx:],
-        batch_size=settings["micro_batch_size"],
-        max_length=gpt_config["context_length"],
-        stride=gpt_config["context_length"],
-        drop_last=False,
-        shuffle=False,
-        num_workers=0
-    )
+        val_loader = create_dataloader_from_shards(
+            data_dir, "val",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=False,
+            shuffle=False,
+            num_workers=0,
+            packing=settings["packing"],
+            group=dp_group
+        )
+    else:
+        # The text file is read and tokenized while training, it is never held in memory
+        train_loader = create_dataloader_streaming(
+            file_path, "train",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=True,
+            num_workers=settings["num_workers"],
+            group=dp_group
+        )
+
+        val_loader = create_dataloader_streaming(
+            file_path, "val",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=False,
+            num_workers=0,
+            group=dp_group
+        )
+
+    if isinstance(train_loader.dataset, PackedTokenDataset):
+        print(f"Packed {len(train_loader.dataset)} training rows, "
+              f"{train_loader.dataset.fill_ratio():.1%} of the positions hold tokens")
 
     ##############################
     # Train model
@@ -522,7 +931,15 @@ def main(rank,world_size,lock,gpt_config, settings):
         start_context="Every effort moves you", tokenizer=tokenizer,
         checkpoint_step = 100 , batch_size = settings["batch_size"],
         micro_batch_size = settings["micro_batch_size"],
-        checkpoint_path=checkpoint_path , rank = rank, lock=lock
+        checkpoint_path=checkpoint_path , rank = rank, lock=lock,
+        precision=settings["precision"],
+        keep_checkpoints=settings["keep_checkpoints"],
+        checkpoint_format=settings["checkpoint_format"],
+        prefetch_batches=settings["prefetch_batches"],
+        eval_batch_size=settings["eval_batch_size"],
+        optimizer_checkpoint=settings["optimizer_checkpoint"],
+        grad_compression=settings["grad_compression"],
+        tp_group=tp_group
     )
     dist.barrier()
     destroy_process_group()
@@ -537,7 +954,11 @@ if __name__ == "__main__":
         "n_heads": 16,          # Number of attention heads
         "n_layers": 16,         # Number of layers
         "drop_rate": 0.1,       # Dropout rate
-        "qkv_bias": False       # Query-key-value bias
+        "qkv_bias": False,      # Query-key-value bias
+        "activation_checkpointing": 0,  # Recompute every k-th block in backward (0 = off, 1 = every block)
+        "loss_chunk_size": 0,    # Positions per out_head/cross entropy chunk (0 = full logits)
+        "tie_embeddings": False,  # Share one matrix between tok_emb and out_head
+        "attn_backend": "sdpa"   # "sdpa", "math", "efficient", "flash", "tiled" or "auto" (see attention.py)
     }
 
     OTHER_SETTINGS = {
@@ -545,11 +966,50 @@ if __name__ == "__main__":
         "num_epochs": 10,
         "batch_size": 64,
         "weight_decay": 0.1,
+        "precision": "fp32",       # "fp32" or "bf16" (autocast, works on CPU too)
+        "data_dir": "data",        # Output of prepare_data.py, falls back to AllCombined.txt if missing
+        "keep_checkpoints": 3,     # Only the newest checkpoints are kept on disk
+        "packing": False,          # Rows of whole documents with per-document attention and positions
+        "num_workers": 2,          # DataLoader worker processes of the train loader
+        "streaming": False,        # Read AllCombined.txt incrementally instead of loading it (no shards)
+        "token_cache_dir": ".token_cache",   # Token shards of AllCombined.txt, keyed by content and tokenizer
+        "prefetch_batches": 2,     # Batches kept ready on the device by the background prefetcher
+        "checkpoint_format": "sharded",  # "sharded" (directory, lazy loading) or "pickle" (one torch.save file)
+        "eval_batch_size": 16,     # No activations are kept for backward, so eval batches can be larger
+        "dist_backend": "auto",    # "nccl", "gloo" or "auto" (nccl with GPUs, gloo on CPU)
+        "compile": True,           # torch.compile the model (needs a C++ compiler on CPU)
+        "zero_optimizer": False,   # Shard the AdamW state across ranks (ZeroRedundancyOptimizer)
+        "optimizer_checkpoint": "consolidated",  # ZeRO state gathered on rank 0, or "sharded" (one file per rank)
+        "grad_compression": None,  # None, "fp16" or "bf16": dtype of the gradients sent in the all-reduce
+        "tensor_parallel": 1,      # Ranks that split the heads/FFN units of every block, the rest is data parallel
+        "pipeline_parallel": 1,    # Pipeline stages the blocks are split into (1F1B over the micro batches)
         "micro_batch_size": 4   # Set micro batch according to your gpu memory
     }
-    world_size = torch.cuda.device_count()
+
+    # Either started by torchrun (one process per rank, everything is in the environment):
+    #   torchrun --nnodes 2 --nproc-per-node 4 --rdzv-backend c10d --rdzv-endpoint host0:29500 MultiGPU_PreTraining.py
+    # or directly, then the processes of this node are spawned here:
+    #   python MultiGPU_PreTraining.py --nnodes 2 --node-rank 0 --nproc-per-node 4 --master-addr host0
+    parser = argparse.ArgumentParser(description="DDP pre-training on one or more nodes")
+    parser.add_argument("--nproc-per-node", type=int, default=torch.cuda.device_count() or 1,
+                        help="Processes on this node, defaults to the number of GPUs (1 without GPUs)")
+    parser.add_argument("--nnodes", type=int, default=1)
+    parser.add_argument("--node-rank", type=int, default=0)
+    parser.add_argument("--master-addr", default=os.environ.get("MASTER_ADDR", "localhost"))
+    parser.add_argument("--master-port", default=os.environ.get("MASTER_PORT", "12355"))
+    parser.add_argument("--backend", default=None, choices=["auto", "nccl", "gloo"])
+    args = parser.parse_args()
+    if args.backend is not None:
+        OTHER_SETTINGS["dist_backend"] = args.backend
+
     ###########################
     # Initiate training
     ###########################
-    lock = mp.Manager().Lock()
-    mp.spawn(main,args=(world_size,lock,GPT_CONFIG_375M,OTHER_SETTINGS,),nprocs=world_size)
+    if "LOCAL_RANK" in os.environ:
+        main(None,GPT_CONFIG_375M,OTHER_SETTINGS)
+    else:
+        os.environ.update(MASTER_ADDR=args.master_addr, MASTER_PORT=str(args.master_port),
+                          WORLD_SIZE=str(args.nnodes * args.nproc_per_node),
+                          LOCAL_WORLD_SIZE=str(args.nproc_per_node), GROUP_RANK=str(args.node_rank))
+        lock = mp.Manager().Lock()
+        mp.spawn(spawn_worker,args=(lock,GPT_CONFIG_375M,OTHER_SETTINGS,),nprocs=args.nproc_per_node)
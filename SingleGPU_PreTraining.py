@@ -1,4 +1,6 @@
 import matplotlib.pyplot as plt
+import copy
+import itertools
 import os
 import torch
 import urllib.request
@@ -6,12 +8,33 @@ import tiktoken
 import os
 import time 
 import math
+import numpy as np
+import threading
 
 import tiktoken
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import Dataset, DataLoader
-import threading
+from prepare_data import (MemmapTokenDataset, PackedTokenDataset, Prefetcher, ResumableLoaderIterator, ResumableSampler,
+                          StreamingTextDataset, TokenStream, cached_token_shards, list_shards)
+from attention import attention
+from checkpointing import AsyncCheckpointer, embeddings_tied, load_checkpoint_file, tie_embedding_weights
+
+
+GPT_CONFIG_124M = {
+    "vocab_size": 50264,    # Vocabulary size
+    "context_length": 1024,  # Shortened context length (orig: 1024)
+    "emb_dim": 1024,         # Embedding dimension
+    "n_heads": 16,          # Number of attention heads
+    "n_layers": 16,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": False,      # Query-key-value bias
+    "activation_checkpointing": 0,  # Recompute every k-th block in backward (0 = off, 1 = every block)
+    "loss_chunk_size": 0,    # Positions per out_head/cross entropy chunk (0 = full logits)
+    "tie_embeddings": False,  # Share one matrix between tok_emb and out_head
+    "attn_backend": "sdpa"   # "sdpa", "math", "efficient", "flash", "tiled" or "auto" (see attention.py)
+}
 
 
 class GPTDatasetV1(Dataset):
@@ -37,23 +60,62 @@ class GPTDatasetV1(Dataset):
 
 
 def create_dataloader_v1(txt, batch_size=4, max_length=256,
-                         stride=128, shuffle=True, drop_last=True, num_workers=0):
+                         stride=128, shuffle=True, drop_last=True, num_workers=0, packing=False):
     # Initialize the tokenizer
     tokenizer = tiktoken.get_encoding("gpt2")
 
     # Create dataset
-    dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
+    if packing:
+        # Rows of whole documents with document ids instead of a sliding window, stride is unused
+        token_ids = tokenizer.encode(txt, allowed_special={"<|endoftext|>"})
+        dataset = PackedTokenDataset(np.asarray(token_ids), max_length)
+    else:
+        dataset = GPTDatasetV1(txt, tokenizer, max_length, stride)
 
     # Create dataloader
     dataloader = DataLoader(
-        dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=num_workers,pin_memory=True)
+        dataset, batch_size=batch_size, sampler=ResumableSampler(dataset, shuffle=shuffle), drop_last=drop_last,
+        num_workers=num_workers,pin_memory=True,
+        # Iterators are created in the prefetch thread, their worker seeds must not come from the global RNG
+        generator=torch.Generator().manual_seed(123))
+
+    return dataloader
+
+
+def create_dataloader_from_shards(data_dir, split, batch_size=4, max_length=256,
+                                  stride=128, shuffle=True, drop_last=True, num_workers=0, packing=False):
+    # Token shards written by prepare_data.py, windows are sliced lazily from a memmap
+    if packing:
+        dataset = PackedTokenDataset(TokenStream(data_dir, split), max_length)
+    else:
+        dataset = MemmapTokenDataset(data_dir, split, max_length, stride)
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, sampler=ResumableSampler(dataset, shuffle=shuffle), drop_last=drop_last,
+        num_workers=num_workers,pin_memory=True,
+        # Iterators are created in the prefetch thread, their worker seeds must not come from the global RNG
+        generator=torch.Generator().manual_seed(123))
+
+    return dataloader
+
+
+def create_dataloader_streaming(file_path, split, batch_size=4, max_length=256,
+                                stride=128, drop_last=True, num_workers=0):
+    # Reads and tokenizes the text file on the fly, for corpora that do not fit in memory.
+    # Documents are split into train/val by StreamingTextDataset
+    dataset = StreamingTextDataset(file_path, split, max_length, stride, batch_size=batch_size,
+                                   num_workers=num_workers)
+
+    dataloader = DataLoader(
+        dataset, batch_size=batch_size, drop_last=drop_last, num_workers=num_workers, pin_memory=True,
+        generator=torch.Generator().manual_seed(123))
 
     return dataloader
 
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_in, d_out, num_heads, context_length, dropout=0.0, qkv_bias=False):
+    def __init__(self, d_in, d_out, num_heads, context_length, dropout=0.0, qkv_bias=False, backend="sdpa"):
         super().__init__()
 
         assert d_out % num_heads == 0, "embed_dim is indivisible by num_heads"
@@ -66,8 +128,9 @@ class MultiHeadAttention(nn.Module):
         self.qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
         self.proj = nn.Linear(d_out, d_out)
         self.dropout = dropout
+        self.backend = backend   # See attention.py
 
-    def forward(self, x):
+    def forward(self, x, cache=None, attn_mask=None):
         batch_size, num_tokens, embed_dim = x.shape
 
         # (b, num_tokens, embed_dim) --> (b, num_tokens, 3 * embed_dim)
@@ -84,8 +147,25 @@ class MultiHeadAttention(nn.Module):
 
         use_dropout = 0. if not self.training else self.dropout
 
-        context_vec = nn.functional.scaled_dot_product_attention(
-            queries, keys, values, attn_mask=None, dropout_p=use_dropout, is_causal=True)
+        if cache is not None:
+            # Incremental decoding: write the new keys/values at their positions and attend
+            # over everything cached so far. cache_k/cache_v: (b, num_heads, window, head_dim),
+            # positions: (b, num_tokens) absolute position of every new token
+            cache_k, cache_v, positions = cache
+            rows = torch.arange(batch_size, device=x.device).unsqueeze(1)
+            cache_k[rows, :, positions] = keys.transpose(1, 2).to(cache_k.dtype)
+            cache_v[rows, :, positions] = values.transpose(1, 2).to(cache_v.dtype)
+
+            # Each query sees the cached keys up to and including its own position
+            key_pos = torch.arange(cache_k.shape[2], device=x.device)
+            attn_mask = key_pos.view(1, 1, 1, -1) <= positions.view(batch_size, 1, num_tokens, 1)
+
+            context_vec = attention(queries, cache_k, cache_v, attn_mask=attn_mask, dropout_p=use_dropout,
+                                    backend=self.backend)
+        else:
+            # attn_mask: block diagonal causal mask of packed rows, plain causal attention without it
+            context_vec = attention(queries, keys, values, attn_mask=attn_mask, dropout_p=use_dropout,
+                                    is_causal=attn_mask is None, backend=self.backend)
 
         # Combine heads, where self.d_out = self.num_heads * self.head_dim
         context_vec = context_vec.transpose(1, 2).contiguous().view(batch_size, num_tokens, self.d_out)
@@ -104,10 +184,8 @@ class LayerNorm(nn.Module):
         self.shift = nn.Parameter(torch.zeros(emb_dim))
 
     def forward(self, x):
-        mean = x.mean(dim=-1, keepdim=True)
-        var = x.var(dim=-1, keepdim=True, unbiased=False)
-        norm_x = (x - mean) / torch.sqrt(var + self.eps)
-        return self.scale * norm_x + self.shift
+        # Single fused kernel, same as (x - mean) / sqrt(var + eps) * scale + shift
+        return nn.functional.layer_norm(x, self.scale.shape, self.scale, self.shift, self.eps)
 
 
 class GELU(nn.Module):
@@ -115,10 +193,8 @@ class GELU(nn.Module):
         super().__init__()
 
     def forward(self, x):
-        return 0.5 * x * (1 + torch.tanh(
-            torch.sqrt(torch.tensor(2.0 / torch.pi)) *
-            (x + 0.044715 * torch.pow(x, 3))
-        ))
+        # Fused tanh approximation: 0.5 * x * (1 + tanh(sqrt(2 / pi) * (x + 0.044715 * x^3)))
+        return nn.functional.gelu(x, approximate="tanh")
 
 
 class FeedForward(nn.Module):
@@ -143,17 +219,18 @@ class TransformerBlock(nn.Module):
             context_length=cfg["context_length"],
             num_heads=cfg["n_heads"],
             dropout=cfg["drop_rate"],
-            qkv_bias=cfg["qkv_bias"])
+            qkv_bias=cfg["qkv_bias"],
+            backend=cfg.get("attn_backend", "sdpa"))
         self.ff = FeedForward(cfg)
         self.norm1 = LayerNorm(cfg["emb_dim"])
         self.norm2 = LayerNorm(cfg["emb_dim"])
         self.drop_shortcut = nn.Dropout(cfg["drop_rate"])
 
-    def forward(self, x):
+    def forward(self, x, cache=None, attn_mask=None):
         # Shortcut connection for attention block
         shortcut = x
         x = self.norm1(x)
-        x = self.att(x)   # Shape [batch_size, num_tokens, emb_size]
+        x = self.att(x, cache, attn_mask)   # Shape [batch_size, num_tokens, emb_size]
         x = self.drop_shortcut(x)
         x = x + shortcut  # Add the original input back
 
@@ -167,6 +244,20 @@ class TransformerBlock(nn.Module):
         return x
 
 
+def document_positions_and_mask(doc_ids):
+    # doc_ids: (b, num_tokens) document of every token of a packed row, see PackedTokenDataset.
+    # Returns the position of every token inside its document and the block diagonal causal
+    # mask (b, 1, num_tokens, num_tokens): a token only attends to earlier tokens of its document
+    idx = torch.arange(doc_ids.shape[1], device=doc_ids.device)
+    is_start = torch.ones_like(doc_ids, dtype=torch.bool)
+    is_start[:, 1:] = doc_ids[:, 1:] != doc_ids[:, :-1]
+    starts = torch.cummax(torch.where(is_start, idx, 0), dim=1).values
+    positions = idx - starts
+    same_doc = doc_ids.unsqueeze(2) == doc_ids.unsqueeze(1)
+    causal = idx.view(-1, 1) >= idx.view(1, -1)
+    return positions, (same_doc & causal).unsqueeze(1)
+
+
 class GPTModel(nn.Module):
     def __init__(self, cfg):
         super().__init__()
@@ -179,18 +270,121 @@ class GPTModel(nn.Module):
 
         self.final_norm = LayerNorm(cfg["emb_dim"])
         self.out_head = nn.Linear(cfg["emb_dim"], cfg["vocab_size"], bias=False)
+        if cfg.get("tie_embeddings", False):
+            # Both are (vocab_size, emb_dim), one parameter serves as embedding and output projection
+            self.out_head.weight = self.tok_emb.weight
+
+        # Activations of every k-th block are recomputed in backward instead of stored
+        self.checkpoint_every = cfg.get("activation_checkpointing", 0)
+        # The training loss computes the logits this many positions at a time
+        self.loss_chunk_size = cfg.get("loss_chunk_size", 0)
+
+    def run_blocks(self, x, attn_mask=None):
+        checkpointing = self.checkpoint_every and self.training and torch.is_grad_enabled()
+        for i, block in enumerate(self.trf_blocks):
+            if checkpointing and i % self.checkpoint_every == 0:
+                x = checkpoint(block, x, None, attn_mask, use_reentrant=False)
+            else:
+                x = block(x, attn_mask=attn_mask)
+        return x
 
-    def forward(self, in_idx):
+    def forward(self, in_idx, kv_cache=None, targets=None, last_only=False, doc_ids=None):
+        # doc_ids: document of every token for packed rows (PackedTokenDataset)
         batch_size, seq_len = in_idx.shape
         tok_embeds = self.tok_emb(in_idx)
-        pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+        attn_mask = None
+        if doc_ids is not None:
+            # Positions restart at every document and attention stays inside it
+            positions, attn_mask = document_positions_and_mask(doc_ids)
+            pos_embeds = self.pos_emb(positions)
+        elif kv_cache is None:
+            pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+        else:
+            # New tokens continue after the positions already in the cache
+            positions = kv_cache.lengths.unsqueeze(1) + torch.arange(seq_len, device=in_idx.device)
+            pos_embeds = self.pos_emb(positions)
         x = tok_embeds + pos_embeds  # Shape [batch_size, num_tokens, emb_size]
         x = self.drop_emb(x)
-        x = self.trf_blocks(x)
+        if kv_cache is None:
+            x = self.run_blocks(x, attn_mask)
+        else:
+            window = int(kv_cache.lengths.max()) + seq_len
+            assert window <= kv_cache.max_length, "KV cache is full"
+            for i, block in enumerate(self.trf_blocks):
+                x = block(x, (kv_cache.keys[i][:, :, :window], kv_cache.values[i][:, :, :window], positions))
+            kv_cache.lengths += seq_len
         x = self.final_norm(x)
+        if targets is not None:
+            return self.loss(x, targets)
+        if last_only:
+            # Generation only needs the logits of the last position
+            x = x[:, -1:, :]
         logits = self.out_head(x)
         return logits
 
+    def loss(self, x, targets):
+        # Mean cross entropy (in fp32) of out_head(x) against targets
+        if not self.loss_chunk_size:
+            logits = self.out_head(x)
+            return nn.functional.cross_entropy(logits.flatten(0, 1).float(), targets.flatten())
+
+        x = x.flatten(0, 1)
+        targets = targets.flatten()
+        total_loss = 0.
+        for start in range(0, x.shape[0], self.loss_chunk_size):
+            end = start + self.loss_chunk_size
+            total_loss = total_loss + checkpoint(self.chunk_loss, x[start:end], targets[start:end], use_reentrant=False)
+        return total_loss / (targets != -100).sum()
+
+    def chunk_loss(self, x, targets):
+        # Under checkpoint the logits of a chunk are freed after the forward pass and
+        # recomputed one chunk at a time in backward, so they never exist for all positions
+        logits = self.out_head(x)
+        return nn.functional.cross_entropy(logits.float(), targets, reduction="sum")
+
+
+class KVCache:
+    # Preallocated key/value buffers of every layer, (b, num_heads, context_length, head_dim) each.
+    # lengths holds the number of cached positions of every row.
+    def __init__(self, model, batch_size):
+        att = model.trf_blocks[0].att
+        self.max_length = model.pos_emb.weight.shape[0]
+        weight = model.tok_emb.weight
+        shape = (batch_size, att.num_heads, self.max_length, att.head_dim)
+        # Under autocast the keys/values come out of the qkv projection in the autocast dtype
+        device_type = weight.device.type
+        dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else weight.dtype
+        self.keys = [torch.zeros(shape, dtype=dtype, device=weight.device) for _ in model.trf_blocks]
+        self.values = [torch.zeros(shape, dtype=dtype, device=weight.device) for _ in model.trf_blocks]
+        self.lengths = torch.zeros(batch_size, dtype=torch.long, device=weight.device)
+
+    def reset(self):
+        self.lengths.zero_()
+
+    def narrow(self, start, length):
+        # Cache over rows [start, start + length) that shares the buffers of this one
+        view = KVCache.__new__(KVCache)
+        view.max_length = self.max_length
+        view.keys = [k[start:start + length] for k in self.keys]
+        view.values = [v[start:start + length] for v in self.values]
+        view.lengths = self.lengths[start:start + length]
+        return view
+
+    def copy_row(self, src, dst):
+        for k, v in zip(self.keys, self.values):
+            k[dst] = k[src]
+            v[dst] = v[src]
+        self.lengths[dst] = self.lengths[src]
+
+    def select(self, rows):
+        # New cache with only the given rows (index or boolean mask), used to drop finished rows
+        view = KVCache.__new__(KVCache)
+        view.max_length = self.max_length
+        view.keys = [k[rows] for k in self.keys]
+        view.values = [v[rows] for v in self.values]
+        view.lengths = self.lengths[rows]
+        return view
+
 
 def generate_text_simple(model, idx, max_new_tokens, context_size):
     # idx is (B, T) array of indices in the current context
@@ -203,7 +397,7 @@ def generate_text_simple(model, idx, max_new_tokens, context_size):
 
         # Get the predictions
         with torch.no_grad():
-            logits = model(idx_cond)
+            logits = model(idx_cond, last_only=True)
 
         # Focus only on the last time step
         # (batch, n_token, vocab_size) becomes (batch, vocab_size)
@@ -217,6 +411,154 @@ def generate_text_simple(model, idx, max_new_tokens, context_size):
 
     return idx
 
+def generate_text_cached(model, idx, max_new_tokens, context_size):
+    # Same tokens as generate_text_simple, but after the prompt only the newest token is fed
+    # through the model, the keys/values of the earlier ones come from the KV cache
+    batch_size, num_tokens = idx.shape
+    out = torch.empty(batch_size, num_tokens + max_new_tokens, dtype=idx.dtype, device=idx.device)
+    out[:, :num_tokens] = idx
+    if max_new_tokens == 0:
+        return out
+
+    kv_cache = KVCache(model, batch_size)
+    with torch.no_grad():
+        # Prefill with the (cropped) prompt
+        cached = min(num_tokens, context_size)
+        logits = model(idx[:, -cached:], kv_cache=kv_cache, last_only=True)
+
+        for i in range(max_new_tokens):
+            idx_next = torch.argmax(logits[:, -1, :], dim=-1, keepdim=True)  # (batch, 1)
+            out[:, num_tokens + i] = idx_next[:, 0]
+            if i == max_new_tokens - 1:
+                break
+
+            if cached < context_size:
+                logits = model(idx_next, kv_cache=kv_cache, last_only=True)
+                cached += 1
+            else:
+                # Cache is full: rebuild it from the last context_size tokens, which is
+                # what generate_text_simple sees once the context gets cropped
+                end = num_tokens + i + 1
+                kv_cache.reset()
+                logits = model(out[:, end - context_size:end], kv_cache=kv_cache, last_only=True)
+
+    return out
+
+
+def _mul32(x, c):
+    # (x * c) mod 2**32 for uint32 values held in int64, without overflowing int64
+    return (x * (c & 0xFFFF) + (((x * (c >> 16)) & 0xFFFF) << 16)) & 0xFFFFFFFF
+
+
+def _mix32(x):
+    # murmur3 finalizer
+    x = x ^ (x >> 16)
+    x = _mul32(x, 0x85EBCA6B)
+    x = x ^ (x >> 13)
+    x = _mul32(x, 0xC2B2AE35)
+    return x ^ (x >> 16)
+
+
+def counter_uniform(seeds, steps):
+    # Uniform numbers in [0, 1) that only depend on (seed, step) of each row, so a row samples
+    # the same tokens whatever else is in the batch. seeds: (b,), steps: int or (b,)
+    steps = torch.as_tensor(steps, dtype=torch.long, device=seeds.device)
+    x = _mix32(_mix32(seeds & 0xFFFFFFFF) ^ (steps & 0xFFFFFFFF))
+    return (x >> 8).float() / 2**24
+
+
+def sample_next_token(logits, temperature=0.0, top_k=None, top_p=None, repetition_penalty=1.0,
+                      prev_tokens=None, seeds=None, steps=0):
+    # logits: (b, vocab_size) of the last position, prev_tokens: (b, t) tokens the repetition
+    # penalty applies to. Returns (b, 1) token ids, every step is batched over the rows.
+
+    # Repetition penalty (CTRL): scale down the logits of tokens that already appeared
+    if repetition_penalty != 1.0 and prev_tokens is not None:
+        seen = torch.zeros_like(logits, dtype=torch.bool).scatter_(1, prev_tokens, True)
+        penalized = torch.where(logits > 0, logits / repetition_penalty, logits * repetition_penalty)
+        logits = torch.where(seen, penalized, logits)
+
+    # Greedy decoding
+    if temperature == 0.0:
+        return torch.argmax(logits, dim=-1, keepdim=True)
+
+    logits = logits / temperature
+
+    # Keep only the top_k logits of every row
+    if top_k is not None:
+        top_logits, _ = torch.topk(logits, min(top_k, logits.shape[-1]))
+        logits = logits.masked_fill(logits < top_logits[:, -1:], float("-inf"))
+
+    # Nucleus sampling: drop a token once the tokens ranked above it already cover top_p
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, dim=-1, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        remove = (torch.cumsum(sorted_probs, dim=-1) - sorted_probs) > top_p
+        remove = remove.scatter(1, sorted_idx, remove)   # Back to vocabulary order
+        logits = logits.masked_fill(remove, float("-inf"))
+
+    probs = torch.softmax(logits.float(), dim=-1)
+    if seeds is None:
+        return torch.multinomial(probs, num_samples=1)
+
+    # Inverse CDF sampling with the per row counter based random numbers
+    cdf = torch.cumsum(probs, dim=-1)
+    u = counter_uniform(seeds, steps).unsqueeze(1) * cdf[:, -1:]
+    return torch.searchsorted(cdf, u, right=True).clamp_(max=probs.shape[-1] - 1)
+
+
+def generate(model, idx, max_new_tokens, context_size, temperature=0.0, top_k=None, top_p=None,
+             repetition_penalty=1.0, eos_id=None, seeds=None):
+    # Batched sampling with the KV cache. A row stops at eos_id and is dropped from the batch,
+    # its remaining positions are filled with eos_id, the result is always
+    # (batch_size, num_tokens + max_new_tokens). seeds: one int per row makes sampling
+    # reproducible, otherwise torch's global generator is used.
+    batch_size, num_tokens = idx.shape
+    out = torch.full((batch_size, num_tokens + max_new_tokens), eos_id if eos_id is not None else 0,
+                     dtype=idx.dtype, device=idx.device)
+    out[:, :num_tokens] = idx
+    if max_new_tokens == 0:
+        return out
+    if seeds is not None:
+        seeds = torch.as_tensor(seeds, dtype=torch.long, device=idx.device)
+
+    rows = torch.arange(batch_size, device=idx.device)   # Row of out for every row still running
+    kv_cache = KVCache(model, batch_size)
+    with torch.no_grad():
+        cached = min(num_tokens, context_size)
+        logits = model(idx[:, -cached:], kv_cache=kv_cache, last_only=True)[:, -1, :]
+
+        for i in range(max_new_tokens):
+            end = num_tokens + i
+            prev_tokens = out[rows, max(0, end - context_size):end] if repetition_penalty != 1.0 else None
+            idx_next = sample_next_token(
+                logits, temperature, top_k, top_p, repetition_penalty, prev_tokens,
+                seeds=None if seeds is None else seeds[rows], steps=i)
+            out[rows, end] = idx_next[:, 0]
+            if i == max_new_tokens - 1:
+                break
+
+            # Drop the rows that just produced eos_id
+            if eos_id is not None:
+                running = idx_next[:, 0] != eos_id
+                if not running.all():
+                    if not running.any():
+                        break   # The rest of out is already eos_id
+                    rows = rows[running]
+                    idx_next = idx_next[running]
+                    kv_cache = kv_cache.select(running)
+
+            if cached < context_size:
+                logits = model(idx_next, kv_cache=kv_cache, last_only=True)[:, -1, :]
+                cached += 1
+            else:
+                # Cache is full: rebuild it from the last context_size tokens
+                kv_cache.reset()
+                logits = model(out[rows, end + 1 - context_size:end + 1], kv_cache=kv_cache, last_only=True)[:, -1, :]
+
+    return out
+
+
 def text_to_token_ids(text, tokenizer):
     encoded = tokenizer.encode(text)
     encoded_tensor = torch.tensor(encoded).unsqueeze(0)  # add batch dimension
@@ -228,14 +570,25 @@ def token_ids_to_text(token_ids, tokenizer):
     return tokenizer.decode(flat.tolist())
 
 
-def calc_loss_batch(input_batch, target_batch, model, device):
+def autocast_context(device, precision):
+    # bf16 has the fp32 exponent range, so mixed precision needs no loss scaling: only the
+    # forward pass runs under autocast, parameters and optimizer state stay in fp32
+    assert precision in ("fp32", "bf16"), f"unknown precision {precision}"
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+def calc_loss_batch(input_batch, target_batch, model, device, precision="fp32", doc_ids=None):
+    # doc_ids: only for packed batches (PackedTokenDataset), see GPTModel.forward
     input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-    logits = model(input_batch)
-    loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), target_batch.flatten())
+    if doc_ids is not None:
+        doc_ids = doc_ids.to(device)
+    with autocast_context(device, precision):
+        # The model computes the cross entropy in fp32, in chunks when loss_chunk_size is set
+        loss = model(input_batch, targets=target_batch, doc_ids=doc_ids)
     return loss
 
 
-def calc_loss_loader(data_loader, model, device, num_batches=None):
+def calc_loss_loader(data_loader, model, device, num_batches=None, precision="fp32"):
     total_loss = 0.
     if len(data_loader) == 0:
         return float("nan")
@@ -243,21 +596,21 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
         num_batches = len(data_loader)
     else:
         num_batches = min(num_batches, len(data_loader))
-    for i, (input_batch, target_batch) in enumerate(data_loader):
+    for i, (input_batch, target_batch, *doc_ids) in enumerate(data_loader):
         if i < num_batches:
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
+            loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *doc_ids)
             total_loss += loss.item()
         else:
             break
     return total_loss / num_batches
 
 
-def generate_and_print_sample(model, tokenizer, device, start_context):
+def generate_and_print_sample(model, tokenizer, device, start_context, precision="fp32"):
     model.eval()
     context_size = model.pos_emb.weight.shape[0]
     encoded = text_to_token_ids(start_context, tokenizer).to(device)
-    with torch.no_grad():
-        token_ids = generate_text_simple(
+    with torch.no_grad(), autocast_context(device, precision):
+        token_ids = generate_text_cached(
             model=model, idx=encoded,
             max_new_tokens=50, context_size=context_size
         )
@@ -278,62 +631,156 @@ def get_lr(iteration,max_lr,min_lr,max_steps,warmup_steps):
     return min_lr + coeff * (max_lr - min_lr)
 
 
-def save_checkpoint(model,optimizer,global_step,prev_time,file_path='checkpoint.pt'):
-    def save():
-        print("Saving CheckPoints ...") 
-        if os.path.exists("checkpoint.pt"):
-            os.remove("checkpoint.pt")
-        
-        model.eval()
-        checkpoint = {
-            'model_state_dict': model.state_dict()   ,      # Save Model state
-            'optimizer_state_dict': optimizer.state_dict(), # Save Optimizer state
-            'step': global_step,  # Current step
-            'random_state': torch.random.get_rng_state(),  # Random state for reproducibility
-            'prev_time' : prev_time
-        }
-        torch.save(checkpoint, file_path)
-        print(f"Checkpoint saved at step {global_step} to {file_path}")
-        print(50*"=")
-        model.train()
-    threading.Thread(target=save).start()
-
-def load_checkpoint(model, optimizer, file_path="checkpoint.pt"):
+def save_checkpoint(checkpointer,model,optimizer,global_step,prev_time,data_state):
+    # Called between two optimizer steps: the tensors are copied to CPU right away and
+    # written in the background, so training only waits for the copy
+    checkpoint = {
+        'model_state_dict': model.state_dict()   ,      # Save Model state
+        'optimizer_state_dict': optimizer.state_dict(), # Save Optimizer state
+        'step': global_step,  # Current step
+        'random_state': torch.random.get_rng_state(),  # Random state for reproducibility
+        'data_state': data_state,  # Position of the train loader (seed, epoch, offset)
+        'prev_time' : prev_time
+    }
+    checkpointer.save(checkpoint, global_step)
+
+def load_model_weights(model, file_path="checkpoint.pt"):
+    # Only the model weights of a training checkpoint, for inference. The base name of a
+    # training run (checkpoint.pt) resolves to its latest checkpoint
+    if not os.path.exists(file_path):
+        file_path = AsyncCheckpointer(file_path).latest() or file_path
+    # Memory mapped, a sharded checkpoint does not even read the optimizer state
+    checkpoint = load_checkpoint_file(file_path, keys=['model_state_dict'], mmap=True, map_location="cpu")
+    state_dict = checkpoint.get('model_state_dict', checkpoint)
+    # Strip the DDP ("module.") and torch.compile ("_orig_mod.") prefixes of the MultiGPU checkpoints
+    state_dict = {k.replace("module.", "", 1).replace("_orig_mod.", "", 1): v for k, v in state_dict.items()}
+    if embeddings_tied(model.state_dict()) and not embeddings_tied(state_dict):
+        state_dict = tie_embedding_weights(state_dict)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def load_checkpoint(model, optimizer, file_path="checkpoint.pt", train_iter=None):
     print("Loading CheckPoints ...")
     # map_location = torch.device('cuda')
-    checkpoint = torch.load(file_path,weights_only=True)
+    checkpoint = load_checkpoint_file(file_path)
     
     # Restore model state
-    model.load_state_dict(checkpoint['model_state_dict'])
-    # Restore optimizer state
-    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    state_dict = checkpoint['model_state_dict']
+    if embeddings_tied(model.state_dict()) and not embeddings_tied(state_dict):
+        # Untied checkpoint for a tied model: average the two matrices, the optimizer state
+        # of the separate matrices does not fit the tied parameter and starts fresh
+        print("Tying tok_emb/out_head of an untied checkpoint, optimizer state is reset")
+        model.load_state_dict(tie_embedding_weights(state_dict))
+    else:
+        model.load_state_dict(state_dict)
+        # Restore optimizer state
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
     
     # Restore random state
     torch.random.set_rng_state(checkpoint['random_state'])
-    
+
+    # Restore data loader position
+    if train_iter is not None and 'data_state' in checkpoint:
+        train_iter.load_state_dict(checkpoint['data_state'])
+
     step = checkpoint['step']
     prev_time = checkpoint['prev_time']
     print(f"Checkpoint loaded from {file_path}, resuming at step {step}")
     return step , prev_time
 
 
-def evaluate(model,train_loader,val_loader,eval_iter,global_step,max_steps,start,epoch,device,prev_time):
-    model.eval()
-    with torch.no_grad():
-        train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
-        val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
-   
+class Evaluator:
+    # Fixed eval set: the first eval_iter batches of the train and val loaders are taken once,
+    # kept on the device and regrouped into batches of eval_batch_size, so every evaluation
+    # sees the same tokens. Losses are summed on the device and synchronized once per evaluation.
+    # With background=True the weights are copied into a CPU model that is evaluated in a
+    # thread while training continues, the result is reported when it is ready.
+    def __init__(self, train_loader, val_loader, device, eval_iter, eval_batch_size, precision="fp32",
+                 background=False):
+        self.device = torch.device("cpu") if background else device
+        self.eval_batch_size = eval_batch_size
+        self.precision = precision
+        self.background = background
+        self.batches = {"train": self.materialize(train_loader, eval_iter),
+                        "val": self.materialize(val_loader, eval_iter)}
+        self.cpu_model = None
+        self.thread = None
+        self.error = None
+
+    def materialize(self, data_loader, num_batches):
+        samples = list(itertools.islice(data_loader, num_batches))
+        if not samples:
+            return []
+        # (input_ids, target_ids) or (input_ids, target_ids, doc_ids) for packed batches
+        columns = [torch.cat(column).to(self.device) for column in zip(*samples)]
+        return [tuple(column[i:i + self.eval_batch_size] for column in columns)
+                for i in range(0, len(columns[0]), self.eval_batch_size)]
+
+    @torch.inference_mode()
+    def losses(self, model):
+        was_training = model.training
+        model.eval()
+        device = next(model.parameters()).device
+        totals = torch.zeros(4, device=device)   # train loss sum, train tokens, val loss sum, val tokens
+        for i, split in enumerate(("train", "val")):
+            for input_batch, target_batch, *doc_ids in self.batches[split]:
+                loss = calc_loss_batch(input_batch, target_batch, model, device, self.precision, *doc_ids)
+                num_targets = (target_batch != -100).sum()
+                totals[2 * i] += loss.float() * num_targets
+                totals[2 * i + 1] += num_targets
+        model.train(was_training)
+        train_sum, train_tokens, val_sum, val_tokens = totals.tolist()
+        return (train_sum / train_tokens if train_tokens else float("nan"),
+                val_sum / val_tokens if val_tokens else float("nan"))
+
+    def run(self, model, report):
+        # report(train_loss, val_loss) is called with the result
+        if not self.background:
+            report(*self.losses(model))
+            return
+        self.wait()
+        if self.cpu_model is None:
+            self.cpu_model = copy.deepcopy(model).to("cpu")
+        else:
+            self.cpu_model.load_state_dict(model.state_dict())
+        self.thread = threading.Thread(target=self.run_background, args=(report,), daemon=True)
+        self.thread.start()
+
+    def run_background(self, report):
+        try:
+            report(*self.losses(self.cpu_model))
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def evaluate(evaluator,model,global_step,max_steps,start,epoch,prev_time):
+    # Returns the time the training loop spent on it, in background mode the losses are printed later
+    def report(train_loss, val_loss):
         print(f"Ep {epoch+1} (Step {global_step:06d}): "
             f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
         curr_time = (time.time() - start) + prev_time
         ETA = ((curr_time/global_step)*(max_steps-global_step))/3600
         print(f"ETA = {ETA} hours")
-    model.train()
+
+    eval_start = time.perf_counter()
+    evaluator.run(model, report)
+    return time.perf_counter() - eval_start
 
 
 def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs,
                        eval_freq, eval_iter, start_context, tokenizer,checkpoint_step,
-                       batch_size,micro_batch_size,checkpoint_path):
+                       batch_size,micro_batch_size,checkpoint_path,precision="fp32",keep_checkpoints=3,
+                       checkpoint_format="pickle",prefetch_batches=2,eval_batch_size=None,
+                       background_eval=False):
     
     global_step = 0
     start = time.time()
@@ -348,24 +795,39 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
 
     print(f"Total Steps = {max_steps}")
 
+    # Taken before the checkpoint is loaded, so a resumed run evaluates on the same batches
+    evaluator = Evaluator(train_loader, val_loader, device, eval_iter, eval_batch_size or micro_batch_size,
+                          precision, background=background_eval)
+
+    # One iterator for the whole run, its position is saved with every checkpoint. The prefetcher
+    # keeps the next batches loaded and on the device while the current step runs
+    train_iter = Prefetcher(ResumableLoaderIterator(train_loader), device, depth=prefetch_batches)
+    step_time = 0.0
+    steps_since_report = 0
+
+    # checkpoint_path is the base name, the files are checkpoint_000020.pt, checkpoint_000040.pt, ...
+    # or the directories checkpoint_000020/, ... with checkpoint_format="sharded"
+    checkpointer = AsyncCheckpointer(checkpoint_path, keep_last=keep_checkpoints,
+                                     sharded=(checkpoint_format == "sharded"))
+
     # Load Checkpoint if exists
     try:
-        global_step , prev_time = load_checkpoint(model, optimizer,checkpoint_path)
+        global_step , prev_time = load_checkpoint(model, optimizer,checkpointer.latest() or checkpoint_path,train_iter)
     except FileNotFoundError:
         print("No checkpoint found, starting from scratch.")
-    except :
-        print("Starting from scratch, checkpoint didn't match the current architecture")
+    except (RuntimeError, ValueError, KeyError) as e:
+        # Missing/unexpected keys or other shapes in load_state_dict, anything else is a real error
+        print(f"Starting from scratch, checkpoint didn't match the current architecture: {e}")
 
     curr_epoch = global_step // per_epoch_steps
-    for _ in range((global_step%per_epoch_steps)-1):
-        next(iter(train_loader))
 
     # Main training loop
     for epoch in range(num_epochs-curr_epoch):
         epoch += curr_epoch
         model.train()  # Set model to training mode
         
-        for _ in range(max_steps//num_epochs):
+        while global_step < (epoch+1) * per_epoch_steps:
+            step_start = time.perf_counter()
             
             # optimizer.zero_grad()  # Reset loss gradients from previous batch iteration
             for param in model.parameters():
@@ -373,8 +835,9 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
                 
             # Gradient Accumulation to overcome small batch size problem
             for _ in range(grad_accum_steps):
-                input_batch, target_batch = next(iter(train_loader))
-                loss = calc_loss_batch(input_batch, target_batch, model, device)
+                # Packed batches also carry the document ids
+                input_batch, target_batch, *doc_ids = next(train_iter)
+                loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *doc_ids)
                 loss = loss / grad_accum_steps
                 loss.backward()  # Calculate loss gradients
                 
@@ -387,22 +850,35 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
             
             optimizer.step()  # Update model weights using loss gradients
             global_step += 1
+            step_time += time.perf_counter() - step_start
+            steps_since_report += 1
 
             # Optional evaluation step
             if global_step % eval_freq == 0:
-                evaluate(model,train_loader,val_loader,eval_iter,global_step,max_steps,start,epoch,device,prev_time)
+                eval_time = evaluate(evaluator,model,global_step,max_steps,start,epoch,prev_time)
+                # Time the loop waited for input, high values mean the data pipeline is the bottleneck
+                print(f"Data wait {train_iter.wait_time / steps_since_report * 1000:.1f} ms/step "
+                      f"({train_iter.wait_time / step_time:.1%} of the step time), "
+                      f"eval overhead {eval_time / step_time:.1%} of the step time")
+                train_iter.wait_time = step_time = 0.0
+                steps_since_report = 0
 
             # Save checkpoints
             if global_step % checkpoint_step == 0:
                 curr_time = (time.time() - start) + prev_time
-                save_checkpoint(model,optimizer,global_step,curr_time)
+                save_checkpoint(checkpointer,model,optimizer,global_step,curr_time,train_iter.state_dict())
             
                
         # Print a sample text after each epoch
         generate_and_print_sample(
-            model, tokenizer, device, start_context
+            model, tokenizer, device, start_context, precision
         )
 
+    train_iter.close()
+    evaluator.wait()
+    checkpointer.wait()   # Let the last checkpoint finish writing
+    print(f"Total training stall for checkpoints: {checkpointer.total_stall:.2f}s")
+
 
 
 def plot_losses(epochs_seen, tokens_seen, train_losses, val_losses):
@@ -434,8 +910,7 @@ def main(gpt_config, settings):
     ##############################
 
     file_path = "AllCombined.txt"
-    with open(file_path, "r", encoding="utf-8") as file:
-        text_data = file.read()
+    data_dir = settings["data_dir"]   # Token shards written by prepare_data.py
 
     ##############################
     # Initialize model
@@ -462,29 +937,56 @@ def main(gpt_config, settings):
     # Set up dataloaders
     ##############################
 
-    # Train/validation ratio
-    train_ratio = 0.90
-    split_idx = int(train_ratio * len(text_data))
-
-    train_loader = create_dataloader_v1(
-        text_data[:split_idx],
-        batch_size=settings["micro_batch_size"],
-        max_length=gpt_config["context_length"],
-        stride=gpt_config["context_length"],
-        drop_last=True,
-        shuffle=True,
-        num_workers=0
-    )
+    if not list_shards(data_dir, "train") and not settings["streaming"]:
+        # Tokenize the corpus once into the token cache, later runs (and the other ranks) reuse it
+        data_dir = cached_token_shards(file_path, settings["token_cache_dir"])
+
+    if list_shards(data_dir, "train"):
+        # Pre-tokenized corpus, nothing is loaded into memory up front
+        train_loader = create_dataloader_from_shards(
+            data_dir, "train",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=True,
+            shuffle=True,
+            num_workers=settings["num_workers"],
+            packing=settings["packing"]
+        )
 
-    val_loader = create_dataloader_v1(
-        text_data[split_idx:],
-        batch_size=settings["micro_batch_size"],
-        max_length=gpt_config["context_length"],
-        stride=gpt_config["context_length"],
-        drop_last=False,
-        shuffle=False,
-        num_workers=0
-    )
+        val_loader = create_dataloader_from_shards(
+            data_dir, "val",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=False,
+            shuffle=False,
+            num_workers=0,
+            packing=settings["packing"]
+        )
+    else:
+        # The text file is read and tokenized while training, it is never held in memory
+        train_loader = create_dataloader_streaming(
+            file_path, "train",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=True,
+            num_workers=settings["num_workers"]
+        )
+
+        val_loader = create_dataloader_streaming(
+            file_path, "val",
+            batch_size=settings["micro_batch_size"],
+            max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"],
+            drop_last=False,
+            num_workers=0
+        )
+
+    if isinstance(train_loader.dataset, PackedTokenDataset):
+        print(f"Packed {len(train_loader.dataset)} training rows, "
+              f"{train_loader.dataset.fill_ratio():.1%} of the positions hold tokens")
 
     ##############################
     # Train model
@@ -498,7 +1000,13 @@ def main(gpt_config, settings):
         start_context="Every effort moves you", tokenizer=tokenizer,
         checkpoint_step = 20 , batch_size = settings["batch_size"],
         micro_batch_size = settings["micro_batch_size"],
-        checkpoint_path=checkpoint_path
+        checkpoint_path=checkpoint_path,
+        precision=settings["precision"],
+        keep_checkpoints=settings["keep_checkpoints"],
+        checkpoint_format=settings["checkpoint_format"],
+        prefetch_batches=settings["prefetch_batches"],
+        eval_batch_size=settings["eval_batch_size"],
+        background_eval=settings["background_eval"]
     )
 
     return model
@@ -506,21 +1014,22 @@ def main(gpt_config, settings):
 
 if __name__ == "__main__":
 
-    GPT_CONFIG_124M = {
-        "vocab_size": 50264,    # Vocabulary size
-        "context_length": 1024,  # Shortened context length (orig: 1024)
-        "emb_dim": 1024,         # Embedding dimension
-        "n_heads": 16,          # Number of attention heads
-        "n_layers": 16,         # Number of layers
-        "drop_rate": 0.1,       # Dropout rate
-        "qkv_bias": False       # Query-key-value bias
-    }
-
     OTHER_SETTINGS = {
         "learning_rate": 3e-4,
         "num_epochs": 10,
         "batch_size": 64,
         "weight_decay": 0.1,
+        "precision": "fp32",       # "fp32" or "bf16" (autocast, works on CPU too)
+        "data_dir": "data",        # Output of prepare_data.py, falls back to AllCombined.txt if missing
+        "keep_checkpoints": 3,     # Only the newest checkpoints are kept on disk
+        "packing": False,          # Rows of whole documents with per-document attention and positions
+        "num_workers": 2,          # DataLoader worker processes of the train loader
+        "streaming": False,        # Read AllCombined.txt incrementally instead of loading it (no shards)
+        "token_cache_dir": ".token_cache",   # Token shards of AllCombined.txt, keyed by content and tokenizer
+        "prefetch_batches": 2,     # Batches kept ready on the device by the background prefetcher
+        "checkpoint_format": "sharded",  # "sharded" (directory, lazy loading) or "pickle" (one torch.save file)
+        "eval_batch_size": 8,      # No activations are kept for backward, so eval batches can be larger
+        "background_eval": False,  # Evaluate a CPU copy of the weights in a thread while training continues
         "micro_batch_size": 2   # Set micro batch according to your gpu memory
     }
 
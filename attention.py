@@ -0,0 +1,153 @@
+import json
+import math
+import os
+
+import torch
+import torch.nn as nn
+from torch.nn.attention import SDPBackend, sdpa_kernel
+
+# Attention backends of MultiHeadAttention, selected with the "attn_backend" config key.
+# All of them take (b, num_heads, num_tokens, head_dim) queries/keys/values and an optional
+# boolean attn_mask (True = attend) like scaled_dot_product_attention.
+#   sdpa       scaled_dot_product_attention, PyTorch picks the kernel
+#   math       the reference SDPA implementation (materializes the attention matrix)
+#   efficient  the memory-efficient SDPA kernel (CUDA only)
+#   flash      the flash attention SDPA kernel (CUDA, and CPU in recent PyTorch versions)
+#   tiled      tiled_attention below, plain PyTorch ops, runs everywhere
+#   auto       the fastest of the above for the shape and mask kind, as measured by `benchmark.py attention`
+BACKEND_CACHE = "attention_backends.json"
+TILE_SIZE = 128
+
+_selected = None      # Contents of BACKEND_CACHE, read on first use
+_causal_tiles = {}    # Lower triangular mask of a diagonal tile, per (size, device)
+
+
+def sdpa(queries, keys, values, attn_mask=None, dropout_p=0.0, is_causal=False):
+    return nn.functional.scaled_dot_product_attention(
+        queries, keys, values, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+
+
+def sdpa_with(backend):
+    def attention(queries, keys, values, attn_mask=None, dropout_p=0.0, is_causal=False):
+        with sdpa_kernel(backend):
+            return sdpa(queries, keys, values, attn_mask, dropout_p, is_causal)
+    return attention
+
+
+def causal_tile(size, device):
+    key = (size, device)
+    if key not in _causal_tiles:
+        _causal_tiles[key] = torch.ones(size, size, dtype=torch.bool, device=device).tril()
+    return _causal_tiles[key]
+
+
+def tiled_attention(queries, keys, values, attn_mask=None, dropout_p=0.0, is_causal=False, tile_size=TILE_SIZE):
+    # Flash style attention: keys/values are visited in tiles of tile_size with an online softmax
+    # (running row max and row sum, the partial output is rescaled when the max grows), so only a
+    # (tile_size x tile_size) block of scores exists at a time. With is_causal the tiles above
+    # the diagonal are skipped and the diagonal ones use one cached triangular mask.
+    # Accumulates in fp32. Gradients go through autograd, which keeps the tiles for backward.
+    scale = 1.0 / math.sqrt(queries.shape[-1])
+    num_queries, num_keys = queries.shape[-2], keys.shape[-2]
+    assert not is_causal or num_queries == num_keys, "is_causal needs as many queries as keys"
+
+    out = []
+    for q_start in range(0, num_queries, tile_size):
+        q = queries[..., q_start:q_start + tile_size, :].float() * scale
+        q_end = q_start + q.shape[-2]
+        row_max = torch.full((*q.shape[:-1], 1), float("-inf"), device=q.device)
+        row_sum = torch.zeros_like(row_max)
+        acc = torch.zeros(q.shape, device=q.device)
+
+        for k_start in range(0, q_end if is_causal else num_keys, tile_size):
+            k = keys[..., k_start:k_start + tile_size, :].float()
+            v = values[..., k_start:k_start + tile_size, :].float()
+            scores = q @ k.transpose(-2, -1)
+
+            mask = None
+            if is_causal and k_start == q_start:
+                mask = causal_tile(tile_size, q.device)[:scores.shape[-2], :scores.shape[-1]]
+            if attn_mask is not None:
+                tile_mask = attn_mask[..., q_start:q_end, k_start:k_start + tile_size]
+                mask = tile_mask if mask is None else mask & tile_mask
+            if mask is not None:
+                scores = scores.masked_fill(~mask, float("-inf"))
+
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # Rows without any visible key so far stay at -inf, subtract 0 there instead of -inf
+            safe_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+            probs = torch.exp(scores - safe_max)
+            rescale = torch.exp(row_max - safe_max)
+            row_sum = row_sum * rescale + probs.sum(dim=-1, keepdim=True)
+            if dropout_p > 0.0:
+                # The row sum stays undropped, as dropout after the softmax in SDPA
+                probs = nn.functional.dropout(probs, dropout_p)
+            acc = acc * rescale + probs @ v
+            row_max = new_max
+
+        out.append((acc / row_sum).to(queries.dtype))
+    return torch.cat(out, dim=-2)
+
+
+BACKENDS = {
+    "sdpa": sdpa,
+    "math": sdpa_with(SDPBackend.MATH),
+    "efficient": sdpa_with(SDPBackend.EFFICIENT_ATTENTION),
+    "flash": sdpa_with(SDPBackend.FLASH_ATTENTION),
+    "tiled": tiled_attention,
+}
+
+
+def mask_kind(attn_mask=None, is_causal=False):
+    # "mask" (explicit boolean mask: packed rows, KV cache), "causal" or "none". The backends
+    # rank differently for them, flash does not take an explicit mask at all
+    if attn_mask is not None:
+        return "mask"
+    return "causal" if is_causal else "none"
+
+
+def kv_bucket(kv_len):
+    # Key/value lengths are rounded up to a power of two: a KV cache decode step attends over
+    # any length up to context_length, one benchmarked length covers all of its bucket
+    return 1 << (kv_len - 1).bit_length()
+
+
+def shape_key(device, dtype, batch_size, seq_len, kv_len, head_dim, mask="causal"):
+    return (f"{device.type}/{str(dtype).replace('torch.', '')}/b{batch_size}/t{seq_len}/kv{kv_bucket(kv_len)}"
+            f"/d{head_dim}/{mask}")
+
+
+def load_backend_cache(path=BACKEND_CACHE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_backend_choice(key, backend, timings, path=BACKEND_CACHE):
+    # timings: {backend: ms} of the measurement, kept in the file for reference
+    global _selected
+    cache = load_backend_cache(path)
+    cache[key] = {"backend": backend, "ms": timings}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    _selected = None   # Re-read on the next lookup
+
+
+def selected_backend(queries, keys, mask="causal"):
+    # Fastest measured backend for this shape and mask kind, plain SDPA for the ones that were
+    # never benchmarked
+    global _selected
+    if _selected is None:
+        _selected = load_backend_cache()
+    batch_size, _, seq_len, head_dim = queries.shape
+    choice = _selected.get(shape_key(queries.device, queries.dtype, batch_size, seq_len, keys.shape[-2], head_dim, mask))
+    return choice["backend"] if choice else "sdpa"
+
+
+def attention(queries, keys, values, attn_mask=None, dropout_p=0.0, is_causal=False, backend="sdpa"):
+    if backend == "auto":
+        backend = selected_backend(queries, keys, mask_kind(attn_mask, is_causal))
+    return BACKENDS[backend](queries, keys, values, attn_mask, dropout_p, is_causal)
@@ -0,0 +1,791 @@
+import argparse
+import contextlib
+import io
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from attention import BACKEND_CACHE, BACKENDS, save_backend_choice, shape_key
+import MultiGPU_PreTraining
+from checkpointing import AsyncCheckpointer, checkpoint_size_mb, load_checkpoint_file, save_sharded
+from pipeline import PipelineModel
+from prepare_data import EOT_ID, PackedTokenDataset, Prefetcher
+from tensor_parallel import gather_state_dict, init_groups, shard_state_dict, tensor_parallel
+from SingleGPU_PreTraining import (GELU, GPT_CONFIG_124M, GPTModel, LayerNorm, TransformerBlock, calc_loss_batch,
+                                   document_positions_and_mask, generate_text_cached, generate_text_simple)
+
+
+def timed(fn, repeat=1):
+    # Best wall time of `repeat` runs, returns (seconds, result of the last run)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_generate(cfg, device, batch_size, prompt_len, max_new_tokens):
+    torch.manual_seed(123)
+    model = GPTModel(cfg).to(device)
+    model.eval()
+    idx = torch.randint(0, cfg["vocab_size"], (batch_size, prompt_len), device=device)
+    context_size = cfg["context_length"]
+
+    with torch.no_grad():
+        simple_time, simple_out = timed(lambda: generate_text_simple(model, idx, max_new_tokens, context_size))
+        cached_time, cached_out = timed(lambda: generate_text_cached(model, idx, max_new_tokens, context_size))
+
+    new_tokens = batch_size * max_new_tokens
+    print(f"generate_text_simple : {new_tokens / simple_time:8.1f} tokens/sec")
+    print(f"generate_text_cached : {new_tokens / cached_time:8.1f} tokens/sec")
+    print(f"Speedup = {simple_time / cached_time:.1f}x, identical output: {torch.equal(simple_out, cached_out)}")
+
+
+class UnfusedLayerNorm(LayerNorm):
+    # The original elementwise chain, kept as the baseline
+    def forward(self, x):
+        mean = x.mean(dim=-1, keepdim=True)
+        var = x.var(dim=-1, keepdim=True, unbiased=False)
+        norm_x = (x - mean) / torch.sqrt(var + self.eps)
+        return self.scale * norm_x + self.shift
+
+
+class UnfusedGELU(GELU):
+    def forward(self, x):
+        return 0.5 * x * (1 + torch.tanh(
+            torch.sqrt(torch.tensor(2.0 / torch.pi)) *
+            (x + 0.044715 * torch.pow(x, 3))
+        ))
+
+
+def saved_activation_mb(fn):
+    # Size of the tensors autograd keeps for the backward pass of fn()
+    seen = {}
+
+    def pack(t):
+        seen[(t.data_ptr(), t.shape, t.dtype)] = t.numel() * t.element_size()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(seen.values()) / 1024**2
+
+
+def bench_fused(cfg, device, batch_size, seq_len, repeat):
+    torch.manual_seed(123)
+    fused = TransformerBlock(cfg).to(device)
+    unfused = TransformerBlock(cfg).to(device)
+    unfused.load_state_dict(fused.state_dict())   # Same parameter names, the state dicts are compatible
+    for block in (fused, unfused):
+        block.eval()   # No dropout, so both blocks compute the same function
+    unfused.norm1.__class__ = unfused.norm2.__class__ = UnfusedLayerNorm
+    unfused.ff.layers[1].__class__ = UnfusedGELU
+
+    x = torch.randn(batch_size, seq_len, cfg["emb_dim"], device=device)
+    print(f"Max abs difference: {(fused(x) - unfused(x)).abs().max().item():.2e}")
+
+    for name, block in (("unfused", unfused), ("fused", fused)):
+        def step():
+            block.zero_grad(set_to_none=True)
+            block(x.requires_grad_()).sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+
+        _, activations = saved_activation_mb(lambda: block(x.requires_grad_()))
+        step()   # Warmup
+        seconds, _ = timed(step, repeat)
+        print(f"{name:8}: {seconds * 1000:8.2f} ms forward+backward per block, {activations:8.1f} MB saved activations")
+
+
+def proc_status_mb(key):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) / 1024   # Reported in kB
+    raise KeyError(key)
+
+
+def reset_peak_memory(device):
+    # Returns the current memory use, the baseline for peak_memory_mb
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return torch.cuda.memory_allocated(device) / 1024**2
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")   # Resets the peak RSS (VmHWM) of this process, Linux only
+    return proc_status_mb("VmRSS")
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024**2
+    return proc_status_mb("VmHWM")
+
+
+def train_step_worker(cfg, device, batch_size, seq_len, repeat, precision, results):
+    # Runs in a fresh process so the CPU peak RSS only reflects this configuration
+    torch.manual_seed(123)
+    model = GPTModel(cfg).to(device)
+    model.train()
+    inputs = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+    targets = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        calc_loss_batch(inputs, targets, model, device, precision).backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    baseline = reset_peak_memory(device)
+    step()
+    peak = peak_memory_mb(device) - baseline
+    seconds, _ = timed(step, repeat)
+    results.put((seconds, peak))
+
+
+def run_train_step(cfg, device, batch_size, seq_len, repeat, precision="fp32"):
+    # (seconds per step, peak step memory in MB), measured in a fresh process
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    worker = ctx.Process(target=train_step_worker, args=(cfg, device, batch_size, seq_len, repeat, precision, results))
+    worker.start()
+    seconds, peak = results.get()
+    worker.join()
+    return seconds, peak
+
+
+def bench_checkpointing(cfg, device, batch_size, seq_len, repeat, every):
+    for k in every:
+        seconds, peak = run_train_step(dict(cfg, activation_checkpointing=k), device, batch_size, seq_len, repeat)
+        label = "off" if k == 0 else ("every block" if k == 1 else f"every {k} blocks")
+        print(f"checkpointing {label:16}: {seconds * 1000:9.1f} ms/step, peak step memory {peak:9.1f} MB")
+
+
+def bench_precision(cfg, device, batch_size, seq_len, repeat):
+    tokens = batch_size * seq_len
+    for precision in ("fp32", "bf16"):
+        seconds, peak = run_train_step(cfg, device, batch_size, seq_len, repeat, precision)
+        print(f"{precision}: {seconds * 1000:9.1f} ms/step, {tokens / seconds:9.1f} tokens/sec, "
+              f"peak step memory {peak:9.1f} MB")
+
+
+def bench_loss_chunking(cfg, device, batch_size, seq_len, repeat, chunk_sizes):
+    # Same loss and gradients, the full logits tensor is never materialized with chunking
+    x = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+    y = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+    reference = None
+    for chunk_size in chunk_sizes:
+        torch.manual_seed(123)
+        model = GPTModel(dict(cfg, loss_chunk_size=chunk_size, drop_rate=0.0)).to(device)
+        loss = model(x, targets=y)
+        loss.backward()
+        grads = torch.cat([p.grad.flatten() for p in model.parameters()])
+        if reference is None:
+            reference = (loss.item(), grads)
+        loss_diff = abs(loss.item() - reference[0])
+        grad_diff = (grads - reference[1]).abs().max().item()
+        del model, grads
+
+        seconds, peak = run_train_step(dict(cfg, loss_chunk_size=chunk_size), device, batch_size, seq_len, repeat)
+        label = "full logits" if chunk_size == 0 else f"chunks of {chunk_size}"
+        print(f"{label:16}: {seconds * 1000:9.1f} ms/step, peak step memory {peak:9.1f} MB, "
+              f"loss diff {loss_diff:.1e}, max grad diff {grad_diff:.1e}")
+
+
+def bench_checkpoint_load(cfg, device, repeat):
+    # Full resume and weights-only load of a torch.save file vs a sharded directory
+    torch.manual_seed(123)
+    model = GPTModel(cfg).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    model(torch.zeros(1, 8, dtype=torch.long, device=device), targets=torch.zeros(1, 8, dtype=torch.long, device=device)).backward()
+    optimizer.step()   # Creates the AdamW moments
+    checkpoint = {'model_state_dict': model.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'step': 1}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {"pickle": os.path.join(tmp, "checkpoint.pt"), "sharded": os.path.join(tmp, "checkpoint")}
+        torch.save(checkpoint, paths["pickle"])
+        save_sharded(checkpoint, paths["sharded"])
+        for name, path in paths.items():
+            full, _ = timed(lambda: load_checkpoint_file(path, map_location="cpu"), repeat)
+            weights, _ = timed(lambda: load_checkpoint_file(path, keys=['model_state_dict'], map_location="cpu"), repeat)
+            lazy, _ = timed(lambda: load_checkpoint_file(path, keys=['model_state_dict'], mmap=True, map_location="cpu"), repeat)
+            print(f"{name:8}: {checkpoint_size_mb(path):8.1f} MB, full load {full * 1000:8.1f} ms, "
+                  f"weights only {weights * 1000:8.1f} ms, weights only mmap {lazy * 1000:8.1f} ms")
+
+
+def bench_loader(cfg, device, batch_size, steps, depth, workers):
+    # Training steps on packed random documents, with and without the background prefetcher
+    rng = np.random.default_rng(123)
+    docs = [np.append(rng.integers(0, EOT_ID, n), EOT_ID) for n in rng.integers(16, cfg["context_length"], 20000)]
+    dataset = PackedTokenDataset(np.concatenate(docs), cfg["context_length"])
+    torch.manual_seed(123)
+    model = GPTModel(cfg).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    for num_workers in workers:
+        for prefetch in (False, True):
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=num_workers,
+                                pin_memory=device.type == "cuda", generator=torch.Generator().manual_seed(123))
+            batches = Prefetcher(loader, device, depth) if prefetch else iter(loader)
+            wait = 0.0
+            for step in range(steps + 1):
+                if step == 1:   # The first step includes the worker start up
+                    start, wait = time.perf_counter(), 0.0
+                wait_start = time.perf_counter()
+                input_batch, target_batch, doc_ids = next(batches)
+                wait += time.perf_counter() - wait_start
+                optimizer.zero_grad(set_to_none=True)
+                calc_loss_batch(input_batch, target_batch, model, device, "fp32", doc_ids).backward()
+                optimizer.step()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            seconds = (time.perf_counter() - start) / steps
+            if prefetch:
+                batches.close()
+            label = f"{num_workers} workers, " + (f"prefetch {depth}" if prefetch else "no prefetch")
+            print(f"{label:26}: {seconds * 1000:8.1f} ms/step, data wait {wait / steps * 1000:8.2f} ms/step "
+                  f"({wait / steps / seconds:.1%})")
+
+
+def bench_attention(cfg, device, batch_sizes, seq_lens, repeat, dtype, backward, cache_path, masks, decode_lens):
+    # Attention of every backend for each (batch, seq_len) shape and mask kind (see
+    # attention.mask_kind), the fastest one is stored in cache_path and used by the models with
+    # attn_backend="auto". "mask" is the block diagonal mask of packed rows, 4 documents per row.
+    # decode_lens are KV cache decode steps: one query per row against that many cached keys
+    # (forward only, the cache lengths in between use the next larger one, see attention.kv_bucket).
+    # Backends that are not available on the device or for the mask are skipped
+    num_heads = cfg["n_heads"]
+    head_dim = cfg["emb_dim"] // num_heads
+    shapes = [(batch_size, seq_len, seq_len, mask)
+              for batch_size, seq_len, mask in itertools.product(batch_sizes, seq_lens, masks)]
+    shapes += [(batch_size, 1, kv_len, "mask") for batch_size, kv_len in itertools.product(batch_sizes, decode_lens)]
+    for batch_size, seq_len, kv_len, mask in shapes:
+        torch.manual_seed(123)
+        grad = backward and seq_len > 1
+        queries = torch.randn(batch_size, num_heads, seq_len, head_dim, device=device, dtype=dtype, requires_grad=grad)
+        qkv = [queries] + [torch.randn(batch_size, num_heads, kv_len, head_dim, device=device, dtype=dtype,
+                                       requires_grad=grad) for _ in range(2)]
+        attn_mask = None
+        if mask == "mask" and seq_len == 1:
+            attn_mask = torch.ones(batch_size, 1, 1, kv_len, dtype=torch.bool, device=device)   # Sees the whole cache
+        elif mask == "mask":
+            doc_ids = (torch.arange(seq_len, device=device) * 4 // seq_len).expand(batch_size, -1)
+            attn_mask = document_positions_and_mask(doc_ids)[1]
+        is_causal = mask == "causal"
+        reference = BACKENDS["math"](*qkv, attn_mask, is_causal=is_causal).float()
+
+        def step(backend):
+            out = BACKENDS[backend](*qkv, attn_mask, is_causal=is_causal)
+            if grad:
+                out.sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            return out
+
+        timings = {}
+        key = shape_key(device, dtype, batch_size, seq_len, kv_len, head_dim, mask)
+        for backend in BACKENDS:
+            try:
+                step(backend)   # Warm up
+                seconds, out = timed(lambda: step(backend), repeat)
+            except RuntimeError:
+                print(f"{key} {backend:9}: not available")
+                continue
+            timings[backend] = round(seconds * 1000, 3)
+            max_diff = (out.float() - reference).abs().max().item()
+            print(f"{key} {backend:9}: {seconds * 1000:9.2f} ms, max diff to math {max_diff:.1e}")
+        best = min(timings, key=timings.get)
+        save_backend_choice(key, best, timings, cache_path)
+        print(f"{key} fastest: {best}")
+
+
+def ddp_env(local_rank, world_size, port):
+    # Environment of one rank on this machine, as torchrun would set it
+    os.environ.update(RANK=str(local_rank), LOCAL_RANK=str(local_rank), WORLD_SIZE=str(world_size),
+                      LOCAL_WORLD_SIZE=str(world_size), MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+
+
+def run_ranks(worker, world_size, port, *args):
+    # Starts world_size processes of worker(rank, world_size, port, *args, results) and returns
+    # the first result put into the queue (by rank 0)
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    workers = [ctx.Process(target=worker, args=(rank, world_size, port, *args, results)) for rank in range(world_size)]
+    for w in workers:
+        w.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if any(w.exitcode not in (None, 0) for w in workers):
+                for w in workers:
+                    w.terminate()
+                raise RuntimeError(f"a rank of {worker.__name__} failed")
+    for w in workers:
+        w.join()
+    return result
+
+
+def ddp_worker(local_rank, world_size, port, cfg, batch_size, seq_len, steps, results):
+    # One rank of bench_ddp
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+    torch.manual_seed(123)
+    model = MultiGPU_PreTraining.DDP(MultiGPU_PreTraining.GPTModel(cfg).to(device))
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    torch.manual_seed(123 + rank)   # Every rank trains on its own batches
+    inputs = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+    targets = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        calc_loss_batch(inputs, targets, model, device).backward()
+        optimizer.step()
+
+    step()   # Warm up, builds the DDP buckets
+    MultiGPU_PreTraining.dist.barrier()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    MultiGPU_PreTraining.dist.barrier()
+    if rank == 0:
+        results.put((time.perf_counter() - start) / steps)
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def bench_ddp(cfg, batch_size, seq_len, steps, world_sizes):
+    # Data parallel training on CPU processes with gloo, every rank runs batch_size rows per step.
+    # The cores are split between the ranks, so the speedup shows how well DDP uses the machine
+    base = None
+    for world_size in world_sizes:
+        seconds = run_ranks(ddp_worker, world_size, 29500 + world_size, cfg, batch_size, seq_len, steps)
+        tokens_per_sec = world_size * batch_size * seq_len / seconds
+        base = base or tokens_per_sec / world_size
+        print(f"{world_size} processes ({max(1, os.cpu_count() // world_size)} threads each): "
+              f"{seconds * 1000:9.1f} ms/step, {tokens_per_sec:9.1f} tokens/sec, "
+              f"speedup {tokens_per_sec / base:.2f}x over 1 process")
+
+
+def zero_worker(local_rank, world_size, port, cfg, zero, results):
+    # One rank of bench_zero, returns the optimizer state per rank in MB
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+    torch.manual_seed(123)
+    model = MultiGPU_PreTraining.DDP(MultiGPU_PreTraining.GPTModel(cfg).to(device))
+    if zero:
+        optimizer = MultiGPU_PreTraining.ZeroRedundancyOptimizer(model.parameters(), optimizer_class=torch.optim.AdamW, lr=1e-4)
+    else:
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    inputs = torch.randint(0, cfg["vocab_size"], (1, 8), device=device)
+    calc_loss_batch(inputs, inputs, model, device).backward()
+    optimizer.step()   # Creates the AdamW moments
+
+    state = optimizer.optim.state if zero else optimizer.state
+    state_mb = sum(t.numel() * t.element_size() for s in state.values() for t in s.values() if torch.is_tensor(t)) / 1024**2
+    sizes = [None] * world_size
+    MultiGPU_PreTraining.dist.all_gather_object(sizes, state_mb)
+    if rank == 0:
+        results.put(sizes)
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def zero_checkpoint_worker(local_rank, world_size, port, cfg, tmp, results):
+    # One rank of the checkpoint round trips of bench_zero. A replicated AdamW (consolidated) and a
+    # ZeroRedundancyOptimizer (consolidated and sharded) are saved after two steps with
+    # save_checkpoint, and every checkpoint is loaded with load_checkpoint into both optimizers.
+    # Returns {round trip: (max abs difference of exp_avg/exp_avg_sq, steps equal)}
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+
+    def build(zero):
+        torch.manual_seed(123)
+        model = MultiGPU_PreTraining.DDP(MultiGPU_PreTraining.GPTModel(cfg).to(device))
+        # Two param groups like the trainer, the state is indexed over both
+        params = list(model.parameters())
+        groups = [{'params': [p for p in params if p.dim() >= 2], 'weight_decay': 0.1},
+                  {'params': [p for p in params if p.dim() < 2], 'weight_decay': 0.0}]
+        if zero:
+            optimizer = MultiGPU_PreTraining.ZeroRedundancyOptimizer(groups, optimizer_class=torch.optim.AdamW, lr=1e-4)
+        else:
+            optimizer = torch.optim.AdamW(groups, lr=1e-4)
+        return model, optimizer
+
+    def full_state(optimizer):
+        # AdamW state of all parameters on rank 0, None on the others. Collective with ZeRO
+        if isinstance(optimizer, MultiGPU_PreTraining.ZeroRedundancyOptimizer):
+            optimizer.consolidate_state_dict(to=0)
+        return optimizer.state_dict()["state"] if rank == 0 else None
+
+    checks = {}
+    for zero, layout in ((False, "consolidated"), (True, "consolidated"), (True, "sharded")):
+        model, optimizer = build(zero)
+        torch.manual_seed(123 + rank)   # Other batches on every rank
+        for _ in range(2):
+            inputs = torch.randint(0, cfg["vocab_size"], (1, 8), device=device)
+            calc_loss_batch(inputs, inputs, model, device).backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        expected = full_state(optimizer)
+
+        path = os.path.join(tmp, f"{'zero' if zero else 'adamw'}_{layout}_{world_size}.pth")
+        checkpointer = AsyncCheckpointer(path)
+        shard_checkpointer = None
+        if layout == "sharded":
+            shard_checkpointer = MultiGPU_PreTraining.optimizer_shard_checkpointer(path, rank)
+        with contextlib.redirect_stdout(io.StringIO()):
+            MultiGPU_PreTraining.save_checkpoint(checkpointer, model, optimizer, 2, 0.0, rank, None, shard_checkpointer)
+            checkpointer.wait()
+            if shard_checkpointer is not None:
+                shard_checkpointer.wait()
+        MultiGPU_PreTraining.dist.barrier()   # Every file is written before any rank loads
+
+        for load_zero in (False, True):
+            model, optimizer = build(load_zero)
+            with contextlib.redirect_stdout(io.StringIO()):
+                MultiGPU_PreTraining.load_checkpoint(
+                    model, optimizer, device, checkpointer.path_for(2),
+                    lambda shard_rank, step: MultiGPU_PreTraining.optimizer_shard_checkpointer(path, shard_rank).path_for(step))
+            loaded = full_state(optimizer)
+            if rank == 0:
+                assert loaded.keys() == expected.keys(), "the loaded state covers other parameters"
+                diff = max((loaded[i][key] - expected[i][key]).abs().max().item()
+                           for i in expected for key in ("exp_avg", "exp_avg_sq"))
+                steps_equal = all(float(loaded[i]["step"]) == float(expected[i]["step"]) for i in expected)
+                name = f"{'ZeRO' if zero else 'AdamW'} {layout} -> {'ZeRO' if load_zero else 'AdamW'}"
+                checks[name] = (diff, steps_equal)
+    if rank == 0:
+        results.put(checks)
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def bench_zero(cfg, world_sizes):
+    # AdamW state (exp_avg, exp_avg_sq) held by every rank, replicated vs ZeroRedundancyOptimizer,
+    # then checks that consolidated and sharded optimizer checkpoints load into both exactly
+    model_mb = sum(p.numel() * p.element_size() for p in GPTModel(cfg).parameters()) / 1024**2
+    print(f"Model parameters: {model_mb:.1f} MB")
+    for world_size in world_sizes:
+        for zero in (False, True):
+            sizes = run_ranks(zero_worker, world_size, 29600 + world_size, cfg, zero)
+            label = f"{world_size} ranks, " + ("ZeRO" if zero else "AdamW")
+            print(f"{label:16}: optimizer state per rank {' '.join(f'{mb:8.1f}' for mb in sizes)} MB "
+                  f"(max {max(sizes) / (2 * model_mb):.2f}x of the replicated state)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for world_size in world_sizes:
+            checks = run_ranks(zero_checkpoint_worker, world_size, 29650 + world_size, cfg, tmp)
+            for name, (diff, steps_equal) in checks.items():
+                assert diff == 0.0 and steps_equal, (f"{world_size} ranks, {name}: exp_avg/exp_avg_sq differ by {diff:.2e}, "
+                                                     f"steps equal {steps_equal}")
+                print(f"{world_size} ranks, {name:30}: exp_avg/exp_avg_sq and step restored exactly, OK")
+
+
+def comm_worker(local_rank, world_size, port, cfg, batch_size, seq_len, grad_accum_steps, steps, compression,
+                bucket_cap_mb, results):
+    # One rank of bench_comm, returns [(all-reduces per micro batch, bytes) of every step], seconds per step
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+    torch.manual_seed(123)
+    model = MultiGPU_PreTraining.DDP(MultiGPU_PreTraining.GPTModel(cfg).to(device), bucket_cap_mb=bucket_cap_mb)
+    comm_stats = MultiGPU_PreTraining.CommStats(compression)
+    model.register_comm_hook(MultiGPU_PreTraining.dist.group.WORLD, comm_stats.hook)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    torch.manual_seed(123 + rank)
+
+    calls_before_batch = []
+
+    def batches():
+        while True:
+            calls_before_batch.append(comm_stats.calls)   # All-reduces of the previous micro batches
+            inputs = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+            yield inputs, inputs
+
+    train_iter = batches()
+    per_step = []
+    start = time.perf_counter()
+    for _ in range(steps):
+        calls_before_batch.clear()
+        MultiGPU_PreTraining.accumulate_gradients(model, train_iter, grad_accum_steps, device)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        per_step.append((calls_before_batch[1:] + [comm_stats.calls], comm_stats.bytes))
+        comm_stats.reset()
+    if rank == 0:
+        results.put((per_step, (time.perf_counter() - start) / steps))
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def bench_comm(cfg, batch_size, seq_len, grad_accum_steps, steps, world_size, bucket_cap_mb):
+    # Gradient all-reduces of a DDP step with accumulation: nothing may be sent for the first
+    # grad_accum_steps - 1 micro batches, and every gradient exactly once in the last one
+    model = GPTModel(cfg)
+    grad_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    num_params = sum(p.numel() for p in model.parameters())
+    for compression in (None, "fp16", "bf16"):
+        per_step, seconds = run_ranks(comm_worker, world_size, 29700, cfg, batch_size, seq_len, grad_accum_steps,
+                                      steps, compression, bucket_cap_mb)
+        expected_bytes = num_params * 2 if compression else grad_bytes
+        for calls, num_bytes in per_step:
+            assert all(c == 0 for c in calls[:-1]), f"all-reduce before the last micro batch: {calls}"
+            assert calls[-1] > 0 and num_bytes == expected_bytes, (calls, num_bytes, expected_bytes)
+        print(f"{compression or 'fp32':5}: {seconds * 1000:9.1f} ms/step, all-reduces per micro batch {per_step[-1][0]}, "
+              f"{per_step[-1][1] / 1024**2:.1f} MB per step (gradients {grad_bytes / 1024**2:.1f} MB), OK")
+
+
+def tensor_worker(local_rank, world_size, port, cfg, batch_size, seq_len, tp_size, results):
+    # One rank of bench_tensor, returns the max abs difference of the logits, the loss, the
+    # gathered gradients and the gathered weights against the unsharded model
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+    tp_group, _ = init_groups(tp_size)
+    torch.manual_seed(123)
+    reference = MultiGPU_PreTraining.GPTModel(cfg).to(device)
+    torch.manual_seed(123)
+    model = MultiGPU_PreTraining.GPTModel(cfg)
+    if tp_group is not None:
+        tensor_parallel(model, tp_group)
+    model.to(device)
+    torch.manual_seed(123)   # The same batch on every rank of a tensor parallel group
+    inputs = torch.randint(0, cfg["vocab_size"], (batch_size, seq_len), device=device)
+
+    diffs = {}
+    logits, ref_logits = model(inputs), reference(inputs)
+    diffs["logits"] = (logits - ref_logits).abs().max().item()
+    loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), inputs.flatten())
+    ref_loss = torch.nn.functional.cross_entropy(ref_logits.flatten(0, 1), inputs.flatten())
+    diffs["loss"] = (loss - ref_loss).abs().item()
+    loss.backward()
+    ref_loss.backward()
+
+    grads = gather_state_dict(model, {name: p.grad for name, p in model.named_parameters()})
+    diffs["grads"] = max((grads[name] - p.grad).abs().max().item() for name, p in reference.named_parameters())
+    state = gather_state_dict(model, model.state_dict())
+    diffs["weights"] = max((state[name] - t).abs().max().item() for name, t in reference.state_dict().items())
+    resharded = shard_state_dict(model, state)
+    diffs["reshard"] = max((resharded[name] - t).abs().max().item() for name, t in model.state_dict().items())
+    local = sum(p.numel() for p in model.trf_blocks.parameters()) / sum(p.numel() for p in reference.trf_blocks.parameters())
+
+    all_diffs = [None] * world_size
+    MultiGPU_PreTraining.dist.all_gather_object(all_diffs, diffs)
+    if rank == 0:
+        results.put((all_diffs, local))
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def bench_tensor(cfg, batch_size, seq_len, tp_sizes, world_size, atol):
+    # Checks that the tensor parallel GPTModel (tensor_parallel.py) computes the same as the
+    # unsharded one on every rank, dropout off. world_size / tp ranks hold the same part
+    cfg = dict(cfg, drop_rate=0.0)
+    for tp_size in tp_sizes:
+        all_diffs, local = run_ranks(tensor_worker, world_size, 29800 + tp_size, cfg, batch_size, seq_len, tp_size)
+        worst = {key: max(d[key] for d in all_diffs) for key in all_diffs[0]}
+        for key, diff in worst.items():
+            assert diff <= atol, f"tensor_parallel={tp_size}: {key} differ by {diff:.2e}"
+        print(f"tensor_parallel={tp_size} of {world_size} ranks: {local * 100:.0f}% of the block parameters per rank, "
+              + ", ".join(f"{key} {diff:.1e}" for key, diff in worst.items()) + " max abs difference, OK")
+
+
+def pipeline_worker(local_rank, world_size, port, cfg, micro_batch_size, seq_len, micro_batch_counts, steps, results):
+    # One rank (stage) of bench_pipeline. Returns the max abs difference of the loss, logits and
+    # gradients against the unsplit model, and (stage times, bubble) of every micro batch count
+    ddp_env(local_rank, world_size, port)
+    rank, world_size, device = MultiGPU_PreTraining.ddp_setup("gloo")
+    group, dp_group = init_groups(world_size)
+    torch.manual_seed(123)
+    reference = MultiGPU_PreTraining.GPTModel(cfg).to(device)
+    torch.manual_seed(123)
+    model = PipelineModel(MultiGPU_PreTraining.GPTModel(cfg), group, dp_group).to(device)
+
+    def micro_batches(count):
+        torch.manual_seed(123)   # The same batches on every stage
+        inputs = torch.randint(0, cfg["vocab_size"], (count, micro_batch_size, seq_len + 1), device=device)
+        return [(x[:, :-1], x[:, 1:]) for x in inputs]
+
+    batches = micro_batches(max(micro_batch_counts))
+    diffs = {}
+    loss = model.train_step(batches)
+    for in_idx, targets in batches:
+        ref_loss = reference(in_idx, targets=targets) / len(batches)
+        ref_loss.backward()
+    grads = model.gather_state_dict({name: p.grad for name, p in model.named_parameters()})
+    if model.last:
+        diffs["loss"] = abs(loss.item() - sum(reference(x, targets=y).item() for x, y in batches) / len(batches))
+    if grads is not None:
+        diffs["grads"] = max((grads["module." + name] - p.grad).abs().max().item() for name, p in reference.named_parameters())
+    with torch.no_grad():
+        in_idx = batches[0][0]
+        diffs["logits"] = (model(in_idx, last_only=True) - reference(in_idx, last_only=True)).abs().max().item()
+
+    timings = []
+    for count in micro_batch_counts:
+        batches = micro_batches(count)
+        model.train_step(batches)   # Warm up
+        model.stats(1)
+        for _ in range(steps):
+            model.train_step(batches)
+            model.zero_grad(set_to_none=True)
+        timings.append(model.stats(steps))
+
+    all_diffs = [None] * world_size
+    MultiGPU_PreTraining.dist.all_gather_object(all_diffs, diffs)
+    if rank == 0:
+        results.put(({k: v for d in all_diffs for k, v in d.items()}, model.blocks, timings))
+    MultiGPU_PreTraining.destroy_process_group()
+
+
+def bench_pipeline(cfg, micro_batch_size, seq_len, micro_batch_counts, steps, stage_counts, atol):
+    # Checks the pipeline parallel GPTModel (pipeline.py) against the unsplit one, dropout off,
+    # then times the 1F1B schedule: forward+backward time of every stage and the bubble, the share
+    # of the step the stages wait, against the ideal (stages - 1) / (micro batches + stages - 1)
+    cfg = dict(cfg, drop_rate=0.0)
+    for num_stages in stage_counts:
+        diffs, blocks, timings = run_ranks(pipeline_worker, num_stages, 29900 + num_stages, cfg, micro_batch_size,
+                                           seq_len, micro_batch_counts, steps)
+        for key, diff in diffs.items():
+            assert diff <= atol, f"{num_stages} stages: {key} differ by {diff:.2e}"
+        print(f"{num_stages} stages: " + ", ".join(f"{key} {diff:.1e}" for key, diff in diffs.items())
+              + " max abs difference, OK")
+        for count, (stage_times, bubble) in zip(micro_batch_counts, timings):
+            ideal = (num_stages - 1) / (count + num_stages - 1)
+            print(f"  {count:3} micro batches: stages {' / '.join(f'{t * 1000:7.1f}' for t in stage_times)} ms/step, "
+                  f"bubble {bubble:6.1%} (1F1B ideal {ideal:6.1%})")
+
+
+def model_config(args):
+    cfg = dict(GPT_CONFIG_124M)
+    for key in ("emb_dim", "n_heads", "n_layers", "context_length"):
+        if getattr(args, key) is not None:
+            cfg[key] = getattr(args, key)
+    return cfg
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for GPTModel training and inference")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--emb-dim", dest="emb_dim", type=int, default=None)
+    parser.add_argument("--n-heads", dest="n_heads", type=int, default=None)
+    parser.add_argument("--n-layers", dest="n_layers", type=int, default=None)
+    parser.add_argument("--context-length", dest="context_length", type=int, default=None)
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    p = subparsers.add_parser("generate", help="KV cached vs uncached greedy generation")
+    p.add_argument("--batch-size", type=int, default=1)
+    p.add_argument("--prompt-len", type=int, default=16)
+    p.add_argument("--max-new-tokens", type=int, default=256)
+
+    p = subparsers.add_parser("fused", help="Fused vs elementwise LayerNorm/GELU in one TransformerBlock")
+    p.add_argument("--batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=1024)
+    p.add_argument("--repeat", type=int, default=5)
+
+    p = subparsers.add_parser("checkpointing", help="Peak memory and step time with activation checkpointing")
+    p.add_argument("--batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=None, help="Defaults to the context length")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--every", type=int, nargs="+", default=[0, 4, 2, 1], help="Values of activation_checkpointing")
+
+    p = subparsers.add_parser("precision", help="fp32 vs bf16 autocast training step")
+    p.add_argument("--batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=None, help="Defaults to the context length")
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = subparsers.add_parser("loss", help="Full vs chunked out_head + cross entropy")
+    p.add_argument("--batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=None, help="Defaults to the context length")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--chunk-sizes", type=int, nargs="+", default=[0, 1024, 256])
+
+    p = subparsers.add_parser("checkpoint", help="torch.save vs sharded checkpoint load time")
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = subparsers.add_parser("loader", help="Data wait per training step with and without prefetching")
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--steps", type=int, default=20)
+    p.add_argument("--depth", type=int, default=2, help="Batches kept ready by the prefetcher")
+    p.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+
+    p = subparsers.add_parser("attention", help="Attention backends per shape, caches the fastest for attn_backend=auto")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 8])
+    p.add_argument("--seq-lens", type=int, nargs="+", default=[128, 512, 1024])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--dtype", choices=["fp32", "bf16"], default="fp32")
+    p.add_argument("--forward-only", action="store_true", help="Time inference only, not forward + backward")
+    p.add_argument("--cache", default=BACKEND_CACHE)
+    p.add_argument("--masks", nargs="+", choices=["causal", "mask", "none"], default=["causal", "mask"],
+                   help="causal: plain training, mask: packed rows and the KV cache, none: no masking")
+    p.add_argument("--decode-lens", type=int, nargs="+", default=[128, 256, 512, 1024],
+                   help="KV cache lengths of the decode steps, powers of two")
+
+    p = subparsers.add_parser("ddp", help="Data parallel training throughput on CPU processes (gloo)")
+    p.add_argument("--batch-size", type=int, default=2, help="Rows per rank and step")
+    p.add_argument("--seq-len", type=int, default=None, help="Defaults to the context length")
+    p.add_argument("--steps", type=int, default=5)
+    p.add_argument("--world-sizes", type=int, nargs="+", default=[1, 2, 4])
+
+    p = subparsers.add_parser("zero", help="Optimizer state per rank, replicated AdamW vs ZeroRedundancyOptimizer, and "
+                               "checks consolidated/sharded optimizer checkpoints load into both (gloo)")
+    p.add_argument("--world-sizes", type=int, nargs="+", default=[1, 2, 4])
+
+    p = subparsers.add_parser("comm", help="Checks one gradient all-reduce per DDP step with accumulation (gloo)")
+    p.add_argument("--batch-size", type=int, default=1, help="Rows per rank and micro batch")
+    p.add_argument("--seq-len", type=int, default=None, help="Defaults to the context length")
+    p.add_argument("--grad-accum-steps", type=int, default=4)
+    p.add_argument("--steps", type=int, default=3)
+    p.add_argument("--world-size", type=int, default=2)
+    p.add_argument("--bucket-cap-mb", type=float, default=25)
+
+    p = subparsers.add_parser("tensor", help="Checks tensor parallel outputs and gradients against the unsharded model (gloo)")
+    p.add_argument("--batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=64)
+    p.add_argument("--tp-sizes", type=int, nargs="+", default=[2, 4])
+    p.add_argument("--world-size", type=int, default=4)
+    p.add_argument("--atol", type=float, default=1e-4)
+
+    p = subparsers.add_parser("pipeline", help="Checks pipeline parallel training against the unsplit model, times 1F1B (gloo)")
+    p.add_argument("--micro-batch-size", type=int, default=2)
+    p.add_argument("--seq-len", type=int, default=64)
+    p.add_argument("--micro-batches", type=int, nargs="+", default=[1, 4, 16], help="grad_accum_steps per step")
+    p.add_argument("--steps", type=int, default=3)
+    p.add_argument("--stages", type=int, nargs="+", default=[2, 4])
+    p.add_argument("--atol", type=float, default=1e-4)
+
+    args = parser.parse_args()
+    cfg = model_config(args)
+    device = torch.device(args.device)
+
+    if args.bench == "generate":
+        bench_generate(cfg, device, args.batch_size, args.prompt_len, args.max_new_tokens)
+    elif args.bench == "fused":
+        bench_fused(cfg, device, args.batch_size, args.seq_len, args.repeat)
+    elif args.bench == "checkpointing":
+        bench_checkpointing(cfg, device, args.batch_size, args.seq_len or cfg["context_length"], args.repeat, args.every)
+    elif args.bench == "precision":
+        bench_precision(cfg, device, args.batch_size, args.seq_len or cfg["context_length"], args.repeat)
+    elif args.bench == "loss":
+        bench_loss_chunking(cfg, device, args.batch_size, args.seq_len or cfg["context_length"], args.repeat, args.chunk_sizes)
+    elif args.bench == "checkpoint":
+        bench_checkpoint_load(cfg, device, args.repeat)
+    elif args.bench == "loader":
+        bench_loader(cfg, device, args.batch_size, args.steps, args.depth, args.workers)
+    elif args.bench == "attention":
+        dtype = torch.bfloat16 if args.dtype == "bf16" else torch.float32
+        bench_attention(cfg, device, args.batch_sizes, args.seq_lens, args.repeat, dtype, not args.forward_only,
+                        args.cache, args.masks, args.decode_lens)
+    elif args.bench == "ddp":
+        bench_ddp(cfg, args.batch_size, args.seq_len or cfg["context_length"], args.steps, args.world_sizes)
+    elif args.bench == "zero":
+        bench_zero(cfg, args.world_sizes)
+    elif args.bench == "comm":
+        bench_comm(cfg, args.batch_size, args.seq_len or cfg["context_length"], args.grad_accum_steps, args.steps,
+                   args.world_size, args.bucket_cap_mb)
+    elif args.bench == "tensor":
+        bench_tensor(cfg, args.batch_size, args.seq_len, args.tp_sizes, args.world_size, args.atol)
+    elif args.bench == "pipeline":
+        bench_pipeline(cfg, args.micro_batch_size, args.seq_len, args.micro_batches, args.steps, args.stages, args.atol)
@@ -0,0 +1,361 @@
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def embedding_keys(state_dict):
+    # (tok_emb key, out_head key), also with the "module." / "_orig_mod." prefixes of DDP and torch.compile
+    tok_key = next(k for k in state_dict if k.endswith("tok_emb.weight"))
+    return tok_key, tok_key[:-len("tok_emb.weight")] + "out_head.weight"
+
+
+def embeddings_tied(state_dict):
+    tok_key, head_key = embedding_keys(state_dict)
+    return state_dict[tok_key].data_ptr() == state_dict[head_key].data_ptr()
+
+
+def tie_embedding_weights(state_dict, mode="average"):
+    # Turns an untied state dict into one for a model with tie_embeddings=True.
+    # mode: "tok_emb" or "out_head" keeps that matrix, "average" uses the mean of both
+    tok_key, head_key = embedding_keys(state_dict)
+    if mode == "tok_emb":
+        weight = state_dict[tok_key]
+    elif mode == "out_head":
+        weight = state_dict[head_key]
+    elif mode == "average":
+        weight = (state_dict[tok_key] + state_dict[head_key]) / 2
+    else:
+        raise ValueError(f"unknown mode {mode}, expected tok_emb, out_head or average")
+
+    state_dict = dict(state_dict)
+    state_dict[tok_key] = weight
+    state_dict[head_key] = weight   # Same tensor, torch.save stores it once
+    return state_dict
+
+
+def convert_to_tied(file_path, out_path, mode="average"):
+    checkpoint = load_checkpoint_file(file_path, map_location="cpu")
+    if embeddings_tied(checkpoint['model_state_dict']):
+        print(f"{file_path} already has tied embeddings")
+        return
+    checkpoint['model_state_dict'] = tie_embedding_weights(checkpoint['model_state_dict'], mode)
+    # The AdamW moments belong to two separate matrices and cannot be mapped onto the tied one
+    checkpoint.pop('optimizer_state_dict', None)
+    if is_sharded(file_path):
+        save_sharded(checkpoint, out_path)
+    else:
+        torch.save(checkpoint, out_path)
+    print(f"Saved tied checkpoint to {out_path} ({checkpoint_size_mb(file_path):.1f} MB -> "
+          f"{checkpoint_size_mb(out_path):.1f} MB), the optimizer state starts fresh")
+
+
+def checkpoint_size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 1024**2
+    return os.path.getsize(path) / 1024**2
+
+
+# Sharded checkpoint layout, a directory:
+#   manifest.json : format version and, for every tensor, its shard file, byte offset, dtype and shape
+#   skeleton.pt   : the checkpoint dict with every tensor replaced by "__tensor__:<name>" (torch.save)
+#   <key>_000.bin : raw tensor bytes of one top-level key ("model_state_dict", ...), 64 byte aligned
+# Every top-level key gets its own shard files, so loading only model_state_dict never touches
+# the optimizer state. Shards are written and read by a thread pool and can be memory mapped.
+SHARDED_VERSION = 1
+SHARD_BYTES = 1024**3
+TENSOR_REF = "__tensor__:"
+ALIGN = 64
+
+
+def is_sharded(path):
+    return os.path.isfile(os.path.join(path, "manifest.json"))
+
+
+def _flatten(obj, name, tensors, memo):
+    # Replaces the tensors of obj by references and collects them in tensors (name -> tensor)
+    if isinstance(obj, torch.Tensor):
+        ident = (obj.data_ptr(), obj.shape, obj.stride(), obj.dtype)
+        if ident not in memo:   # Tied weights are stored once
+            memo[ident] = name
+            tensors[name] = obj
+        return TENSOR_REF + memo[ident]
+    if isinstance(obj, dict):
+        return {k: _flatten(v, f"{name}/{k}", tensors, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(v, f"{name}/{i}", tensors, memo) for i, v in enumerate(obj))
+    return obj
+
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, str) and obj.startswith(TENSOR_REF):
+        return tensors[obj[len(TENSOR_REF):]]
+    if isinstance(obj, dict):
+        return {k: _unflatten(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_unflatten(v, tensors) for v in obj)
+    return obj
+
+
+def _write_shard(file_path, tensors):
+    with open(file_path, "wb") as f:
+        for tensor in tensors:
+            f.write(bytes(-f.tell() % ALIGN))
+            f.write(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_sharded(checkpoint, path, shard_bytes=SHARD_BYTES, num_threads=8):
+    tensors, memo = {}, {}
+    skeleton = {key: _flatten(value, key, tensors, memo) for key, value in checkpoint.items()}
+
+    # Assign the tensors to shards, per top-level key, and compute their offsets
+    manifest = {"format": "sharded", "version": SHARDED_VERSION, "tensors": {}}
+    shards = {}
+    for name, tensor in tensors.items():
+        key = name.split("/", 1)[0]
+        index = 0
+        while True:
+            file_name = f"{key}_{index:03d}.bin"
+            shard = shards.setdefault(file_name, {"tensors": [], "size": 0})
+            offset = shard["size"] + (-shard["size"] % ALIGN)
+            nbytes = tensor.numel() * tensor.element_size()
+            if shard["size"] == 0 or offset + nbytes <= shard_bytes:
+                break
+            index += 1
+        shard["tensors"].append(tensor)
+        shard["size"] = offset + nbytes
+        manifest["tensors"][name] = {"file": file_name, "offset": offset, "dtype": str(tensor.dtype).split(".")[-1],
+                                     "shape": list(tensor.shape)}
+
+    # Write everything into a temporary directory and rename it into place
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(lambda item: _write_shard(os.path.join(tmp_path, item[0]), item[1]["tensors"]), shards.items()))
+    torch.save(skeleton, os.path.join(tmp_path, "skeleton.pt"))
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+    if os.path.exists(path):
+        old_path = path + ".old"
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.replace(tmp_path, path)
+
+
+def _read_shard(file_path, mmap):
+    size = os.path.getsize(file_path)
+    if mmap:
+        # Private mapping, pages are only read from disk when a tensor is used
+        return torch.from_file(file_path, shared=False, size=size, dtype=torch.uint8)
+    buffer = torch.empty(size, dtype=torch.uint8)
+    with open(file_path, "rb") as f:
+        f.readinto(buffer.numpy())
+    return buffer
+
+
+def load_sharded(path, keys=None, mmap=False, num_threads=8):
+    # keys: top-level entries to load (e.g. ["model_state_dict"]), None loads everything.
+    # With mmap=True the tensors are views into memory mapped shards.
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    assert manifest["version"] == SHARDED_VERSION, f"unsupported sharded checkpoint version {manifest['version']}"
+    skeleton = torch.load(os.path.join(path, "skeleton.pt"), weights_only=True)
+    if keys is not None:
+        skeleton = {key: skeleton[key] for key in keys if key in skeleton}
+
+    entries = {name: entry for name, entry in manifest["tensors"].items()
+               if name.split("/", 1)[0] in skeleton}
+    file_names = sorted({entry["file"] for entry in entries.values()})
+    with ThreadPoolExecutor(num_threads) as pool:
+        buffers = dict(zip(file_names, pool.map(lambda name: _read_shard(os.path.join(path, name), mmap), file_names)))
+
+    tensors = {}
+    for name, entry in entries.items():
+        dtype = getattr(torch, entry["dtype"])
+        nbytes = math.prod(entry["shape"]) * dtype.itemsize
+        data = buffers[entry["file"]][entry["offset"]:entry["offset"] + nbytes]
+        tensors[name] = data.view(dtype).reshape(entry["shape"])
+    return _unflatten(skeleton, tensors)
+
+
+def load_checkpoint_file(path, keys=None, mmap=False, map_location=None):
+    # Loads a sharded checkpoint directory or a torch.save file, optionally only some top-level keys
+    if is_sharded(path):
+        return load_sharded(path, keys, mmap)
+    checkpoint = torch.load(path, map_location=map_location, weights_only=True, mmap=mmap)
+    if keys is not None and isinstance(checkpoint, dict) and any(key in checkpoint for key in keys):
+        checkpoint = {key: checkpoint[key] for key in keys if key in checkpoint}
+    return checkpoint
+
+
+def convert_checkpoint(path, out_path):
+    # torch.save file <-> sharded directory, in the direction given by the input
+    checkpoint = load_checkpoint_file(path, map_location="cpu")
+    if is_sharded(path):
+        torch.save(checkpoint, out_path)
+    else:
+        save_sharded(checkpoint, out_path)
+    print(f"Converted {path} to {out_path}")
+
+
+def optimizer_shard(optimizer):
+    # State of the parameters a ZeroRedundancyOptimizer updates on this rank, keyed by their
+    # index in the full optimizer (the keys of optimizer.state_dict()["state"])
+    index = {id(p): i for i, p in enumerate(p for group in optimizer.param_groups for p in group["params"])}
+    local_params = [p for group in optimizer.optim.param_groups for p in group["params"]]
+    local_state = optimizer.optim.state_dict()["state"]
+    return {"state": {index[id(local_params[i])]: state for i, state in local_state.items()}}
+
+
+def merge_optimizer_shards(shards, optimizer):
+    # Optimizer state dict from the shards of some or all ranks, for optimizer.load_state_dict of
+    # a plain optimizer or a ZeroRedundancyOptimizer of any world size. The hyperparameters of
+    # the param groups are the ones of `optimizer`
+    param_groups, start = [], 0
+    for group in optimizer.param_groups:
+        num_params = len(group["params"])
+        param_groups.append({**{k: v for k, v in group.items() if k != "params"},
+                             "params": list(range(start, start + num_params))})
+        start += num_params
+    state = {}
+    for shard in shards:
+        state.update(shard["state"])
+    return {"state": state, "param_groups": param_groups}
+
+
+class AsyncCheckpointer:
+    # Snapshot-then-write checkpointing. save() is called at a step boundary and copies every
+    # tensor of the checkpoint into CPU buffers (pinned with CUDA, reused between saves), so the
+    # snapshot is one consistent step. A background thread then writes it to a temporary file
+    # and renames it into place, so a crash never leaves a broken or missing checkpoint.
+    # Checkpoints are named {root}_{step:06d}{ext} next to file_path, or {root}_{step:06d}/ with
+    # sharded=True (see save_sharded), and only the last keep_last stay.
+    def __init__(self, file_path="checkpoint.pt", keep_last=3, sharded=False):
+        self.file_path = file_path
+        self.root, self.ext = os.path.splitext(file_path)
+        self.keep_last = keep_last
+        self.sharded = sharded
+        self.pin_memory = torch.cuda.is_available()
+        self.buffers = {}
+        self.thread = None
+        self.error = None
+        self.last_stall = 0.0
+        self.total_stall = 0.0
+
+    def path_for(self, step):
+        return f"{self.root}_{step:06d}" + ("" if self.sharded else self.ext)
+
+    def saved_paths(self):
+        # Checkpoints of both formats, oldest first
+        directory, base = os.path.split(self.root)
+        pattern = re.compile(re.escape(base) + r"_(\d+)(" + re.escape(self.ext) + ")?")
+        steps = {}
+        for name in os.listdir(directory or "."):
+            match = pattern.fullmatch(name)
+            path = os.path.join(directory, name)
+            if match and (os.path.isfile(path) or is_sharded(path)):
+                steps[path] = int(match.group(1))   # Numeric, steps can outgrow the zero padding
+        return sorted(steps, key=steps.get)
+
+    def latest(self):
+        # Newest checkpoint, or a plain file_path written by an older version of the scripts
+        paths = self.saved_paths()
+        if paths:
+            return paths[-1]
+        return self.file_path if os.path.exists(self.file_path) else None
+
+    def save(self, checkpoint, step):
+        start = time.perf_counter()
+        self.wait()   # The buffers of the previous snapshot are reused
+        memo = {}
+        snapshot = self.snapshot(checkpoint, "", memo)
+        if self.pin_memory:
+            torch.cuda.synchronize()   # Wait for the non_blocking device to host copies
+        self.thread = threading.Thread(target=self.write, args=(snapshot, step))
+        self.thread.start()
+
+        self.last_stall = time.perf_counter() - start
+        self.total_stall += self.last_stall
+        print(f"Checkpoint snapshot at step {step}, training stalled {self.last_stall * 1000:.1f} ms")
+
+    def snapshot(self, obj, key, memo):
+        if isinstance(obj, torch.Tensor):
+            # Tensors that share storage (tied embeddings) share one buffer as well
+            ident = (obj.data_ptr(), obj.shape, obj.stride(), obj.dtype)
+            if ident in memo:
+                return memo[ident]
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory)
+                self.buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=self.pin_memory)
+            memo[ident] = buffer
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v, f"{key}/{k}", memo) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, f"{key}/{i}", memo) for i, v in enumerate(obj))
+        return obj
+
+    def write(self, snapshot, step):
+        try:
+            path = self.path_for(step)
+            if self.sharded:
+                save_sharded(snapshot, path)
+            else:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    torch.save(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            print(f"Checkpoint saved at step {step} to {path}")
+
+            for old_path in self.saved_paths()[:-self.keep_last]:
+                if os.path.isdir(old_path):
+                    shutil.rmtree(old_path)
+                else:
+                    os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing the last checkpoint failed") from error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checkpoint conversion tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("tie", help="Convert an untied checkpoint for tie_embeddings=True")
+    p.add_argument("checkpoint")
+    p.add_argument("out")
+    p.add_argument("--mode", choices=["tok_emb", "out_head", "average"], default="average")
+
+    p = subparsers.add_parser("convert", help="Convert a torch.save checkpoint to a sharded directory or back")
+    p.add_argument("checkpoint")
+    p.add_argument("out")
+
+    args = parser.parse_args()
+    if args.command == "tie":
+        convert_to_tied(args.checkpoint, args.out, args.mode)
+    elif args.command == "convert":
+        convert_checkpoint(args.checkpoint, args.out)
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import sys
+import time
+
+import tiktoken
+import torch
+
+from SingleGPU_PreTraining import GPT_CONFIG_124M, GPTModel, KVCache, load_model_weights, sample_next_token
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, seed, future):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.seed = seed
+        self.future = future
+        self.new_tokens = []
+        self.submit_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_reason = None
+
+
+class InferenceEngine:
+    # Continuous batching over one KV cache with max_batch_size rows. Every decode step runs
+    # all active requests as one batch; rows have different lengths and the KV cache mask keeps
+    # each row to its own positions. Finished requests leave the batch after any step and
+    # queued ones are prefilled into the free rows before the next one.
+    def __init__(self, model, max_batch_size=8, eos_id=None, temperature=0.0, top_k=None, top_p=None,
+                 repetition_penalty=1.0):
+        self.model = model.eval()
+        self.device = model.tok_emb.weight.device
+        self.context_size = model.pos_emb.weight.shape[0]
+        self.max_batch_size = max_batch_size
+        self.eos_id = eos_id
+        self.sampling = dict(temperature=temperature, top_k=top_k, top_p=top_p,
+                             repetition_penalty=repetition_penalty)
+        self.kv_cache = KVCache(model, max_batch_size)
+        self.active = []          # Request in row i of the KV cache, rows are kept contiguous
+        self.queue = asyncio.Queue()
+
+        # Aggregate statistics
+        self.generated_tokens = 0
+        self.busy_time = 0.0
+
+    async def generate(self, prompt_ids, max_new_tokens=50, seed=None):
+        # The same (prompt, seed) always gives the same completion
+        if len(prompt_ids) == 0:
+            raise ValueError("prompt_ids is empty")
+        if max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be at least 1, got {max_new_tokens}")
+        if seed is None:
+            seed = int(torch.randint(2**31, (1,)))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(GenerationRequest(prompt_ids, max_new_tokens, seed, future))
+        return await future
+
+    async def run(self):
+        while True:
+            admitted = []
+            if not self.active:
+                # Idle, wait for the next request
+                admitted.append(await self.queue.get())
+            while len(self.active) + len(admitted) < self.max_batch_size and not self.queue.empty():
+                admitted.append(self.queue.get_nowait())
+
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.step, admitted)
+            except Exception as exc:
+                # The batch is lost (OOM, bad token id, ...): fail its requests, keep serving the queue
+                self.fail_all(admitted, exc)
+                continue
+            finally:
+                self.busy_time += time.perf_counter() - start
+
+            self.retire_finished()
+
+    def fail_all(self, admitted, exc):
+        # The failed step may have admitted only part of the new requests into self.active
+        failed = self.active + [req for req in admitted if req not in self.active]
+        self.active = []   # Rows are reset when the next requests are prefilled
+        for req in failed:
+            if not req.future.done():
+                req.future.set_exception(exc)
+
+    @torch.no_grad()
+    def step(self, admitted):
+        # One decode step for the running requests, then prefill of the new ones
+        num_active = len(self.active)
+        if num_active > 0:
+            last_tokens = torch.tensor([[req.new_tokens[-1]] for req in self.active], device=self.device)
+            logits = self.model(last_tokens, kv_cache=self.kv_cache.narrow(0, num_active), last_only=True)
+            for req, token in zip(self.active, self.sample(self.active, logits[:, -1, :])):
+                self.append_token(req, token)
+
+        for req in admitted:
+            row = len(self.active)
+            self.active.append(req)
+            row_cache = self.kv_cache.narrow(row, 1)
+            row_cache.reset()
+            prompt = torch.tensor(req.prompt_ids[-self.context_size:], device=self.device).unsqueeze(0)
+            logits = self.model(prompt, kv_cache=row_cache, last_only=True)
+            self.append_token(req, self.sample([req], logits[:, -1, :])[0])
+
+    def sample(self, reqs, logits):
+        seeds = torch.tensor([req.seed for req in reqs], device=self.device)
+        steps = torch.tensor([len(req.new_tokens) for req in reqs], device=self.device)
+        prev_tokens = None
+        if self.sampling["repetition_penalty"] != 1.0:
+            # Context of every row, padded with its last token (already in the row, so no effect)
+            contexts = [(req.prompt_ids + req.new_tokens)[-self.context_size:] for req in reqs]
+            width = max(len(c) for c in contexts)
+            prev_tokens = torch.tensor([c + c[-1:] * (width - len(c)) for c in contexts], device=self.device)
+        next_tokens = sample_next_token(logits, prev_tokens=prev_tokens, seeds=seeds, steps=steps, **self.sampling)
+        return next_tokens[:, 0].tolist()
+
+    def append_token(self, req, token):
+        req.new_tokens.append(token)
+        self.generated_tokens += 1
+        if req.first_token_time is None:
+            req.first_token_time = time.perf_counter()
+        if self.eos_id is not None and token == self.eos_id:
+            req.finish_reason = "eos"
+        elif len(req.new_tokens) >= req.max_new_tokens:
+            req.finish_reason = "max_new_tokens"
+        elif len(req.prompt_ids[-self.context_size:]) + len(req.new_tokens) >= self.context_size:
+            # The next token would not fit in the KV cache any more
+            req.finish_reason = "context_length"
+
+    def retire_finished(self):
+        row = 0
+        while row < len(self.active):
+            req = self.active[row]
+            if req.finish_reason is None:
+                row += 1
+                continue
+            # Move the last row into the free one so the active rows stay contiguous
+            last = len(self.active) - 1
+            if row != last:
+                self.kv_cache.copy_row(last, row)
+            self.active[row] = self.active[last]
+            self.active.pop()
+
+            if req.future.done():
+                continue   # The client stopped waiting
+            now = time.perf_counter()
+            req.future.set_result({
+                "token_ids": req.new_tokens,
+                "finish_reason": req.finish_reason,
+                "latency": now - req.submit_time,
+                "time_to_first_token": req.first_token_time - req.submit_time,
+            })
+
+    def tokens_per_sec(self):
+        return self.generated_tokens / max(self.busy_time, 1e-9)
+
+
+async def serve_stdin(engine, tokenizer, max_new_tokens):
+    # Every line on stdin is a prompt, completions are printed as soon as they finish
+    loop = asyncio.get_running_loop()
+    engine_task = asyncio.create_task(engine.run())
+    pending = set()
+
+    async def complete(request_id, prompt):
+        try:
+            result = await engine.generate(tokenizer.encode(prompt), max_new_tokens)
+        except Exception as exc:
+            print(f"[{request_id}] failed: {exc!r}")
+            return
+        text = tokenizer.decode(result["token_ids"])
+        print(f"[{request_id}] {prompt}{text}".replace("\n", " "))
+        print(f"[{request_id}] {len(result['token_ids'])} tokens, latency {result['latency']:.2f}s, "
+              f"first token {result['time_to_first_token']:.2f}s, finish reason {result['finish_reason']}")
+
+    request_id = 0
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            break
+        prompt = line.rstrip("\n")
+        if not prompt:
+            continue
+        task = asyncio.create_task(complete(request_id, prompt))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        request_id += 1
+
+    if pending:
+        await asyncio.gather(*pending)
+    engine_task.cancel()
+    print(f"{engine.generated_tokens} tokens generated, {engine.tokens_per_sec():.1f} tokens/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuous batching inference over GPTModel, one prompt per stdin line")
+    parser.add_argument("--checkpoint", default="checkpoint.pt")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=50)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 = greedy decoding")
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    args = parser.parse_args()
+
+    tokenizer = tiktoken.get_encoding("gpt2")
+    model = GPTModel(GPT_CONFIG_124M)
+    load_model_weights(model, args.checkpoint)
+    model.to(args.device)
+
+    engine = InferenceEngine(model, max_batch_size=args.max_batch_size, eos_id=tokenizer.eot_token,
+                             temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                             repetition_penalty=args.repetition_penalty)
+    asyncio.run(serve_stdin(engine, tokenizer, args.max_new_tokens))
@@ -0,0 +1,215 @@
+import time
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+# Pipeline parallelism for GPTModel. The ranks of a pipeline group are its stages: stage 0 keeps
+# the embeddings, every stage a consecutive range of trf_blocks, the last stage final_norm,
+# out_head and the loss. Only the hidden states (batch, num_tokens, emb_dim) travel between
+# stages, forward with send/recv to the next stage, their gradients backward to the previous one.
+# Every stage reads the same batches from its data loader (input ids for the first stage,
+# targets for the last, doc_ids of packed rows for the attention masks of all of them).
+#
+# A training step runs the grad_accum_steps micro batches with the 1F1B schedule: stage s starts
+# with num_stages - s - 1 forwards, then alternates one forward and one backward, then finishes
+# the backwards. At most num_stages micro batches are in flight per stage, and the pipeline
+# idles for (num_stages - 1) / (grad_accum_steps + num_stages - 1) of the step (the bubble).
+# With more ranks than stages, the stages with the same position form data parallel groups.
+
+
+def partition(num_blocks, num_stages, head_blocks=0.0):
+    # [start, end) of the blocks of every stage. The last stage also runs out_head and the loss,
+    # which cost about head_blocks blocks, so it gets fewer blocks (possibly none), the others
+    # at least one
+    assert num_blocks >= num_stages - 1, f"{num_blocks} blocks are too few for {num_stages} stages"
+    total = num_blocks + head_blocks
+    bounds = [0]
+    for stage in range(1, num_stages):
+        bound = max(bounds[-1] + 1, round(total * stage / num_stages))
+        bounds.append(min(num_blocks - (num_stages - 1 - stage), bound))
+    bounds.append(num_blocks)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class PipelineModel(nn.Module):
+    # One stage of a GPTModel split over group. Build the full model with the same seed on every
+    # rank, PipelineModel(model, group, dp_group) drops the layers of the other stages.
+    # Called like the model, it runs the micro batch through all stages without a schedule
+    # (evaluation and generation); train_step runs the 1F1B schedule of a training step
+    def __init__(self, model, group, dp_group):
+        super().__init__()
+        assert model.out_head.weight is not model.tok_emb.weight, "tied embeddings can't be split into stages"
+        self.group = group
+        self.dp_group = dp_group
+        self.ranks = dist.get_process_group_ranks(group)
+        self.num_stages = len(self.ranks)
+        self.stage = dist.get_rank(group)
+        self.first = self.stage == 0
+        self.last = self.stage == self.num_stages - 1
+        self.emb_dim = model.tok_emb.weight.shape[1]
+        self.vocab_size = model.out_head.weight.shape[0]
+
+        block_params = sum(p.numel() for p in model.trf_blocks[0].parameters())
+        start, end = partition(len(model.trf_blocks), self.num_stages, model.out_head.weight.numel() / block_params)[self.stage]
+        self.blocks = (start, end)
+        # Slicing keeps the block names, the state dict keys stay those of the full model
+        model.trf_blocks = model.trf_blocks[start:end]
+        if not self.first:
+            model.tok_emb = model.pos_emb = None
+        if not self.last:
+            model.final_norm = model.out_head = None
+        self.module = model
+        self.run_blocks = model.run_blocks
+
+        self.compute_time = 0.0   # Forward and backward of this stage, since the last stats()
+        self.step_time = 0.0      # Whole train_step, including the waits for the other stages
+
+    def compile_stage(self):
+        # Compiles the blocks only, the parameter names stay the same
+        self.run_blocks = torch.compile(self.module.run_blocks)
+
+    def stage_forward(self, x, in_idx, targets=None, last_only=False, doc_ids=None):
+        # x: hidden states from the previous stage, None on the first stage
+        positions, attn_mask = self.module.positions_and_mask(in_idx, doc_ids)
+        if self.first:
+            x = self.module.embed(in_idx, positions)
+        x = self.run_blocks(x, attn_mask)
+        if self.last:
+            return self.module.head(x, targets, last_only)
+        return x
+
+    def hidden_buffer(self, in_idx):
+        param = next(self.parameters())
+        return torch.empty(*in_idx.shape, self.emb_dim, dtype=param.dtype, device=param.device)
+
+    def forward(self, in_idx, targets=None, last_only=False, doc_ids=None):
+        # The loss on the last stage (None on the others), or the logits on every stage
+        x = None
+        if not self.first:
+            x = self.hidden_buffer(in_idx)
+            dist.recv(x, self.ranks[self.stage - 1], group=self.group)
+        out = self.stage_forward(x, in_idx, targets, last_only, doc_ids)
+        if not self.last:
+            dist.send(out.contiguous(), self.ranks[self.stage + 1], group=self.group)
+        if targets is not None:
+            return out if self.last else None
+        if self.last:
+            out = out.float()   # bf16 under autocast, the other stages can't know
+        else:
+            out = torch.empty(in_idx.shape[0], 1 if last_only else in_idx.shape[1], self.vocab_size, device=in_idx.device)
+        dist.broadcast(out, self.ranks[-1], group=self.group)   # Generation continues on all stages
+        return out
+
+    def train_step(self, batches, precision="fp32"):
+        # Forward and backward of the micro batches (input_ids, target_ids[, doc_ids]) with the 1F1B
+        # schedule, then the gradients are averaged over dp_group. Sends are asynchronous, a stage
+        # only waits in recv. Returns the mean loss on the last stage, None on the others
+        step_start = time.perf_counter()
+        num_micro = len(batches)
+        warmup = min(self.num_stages - self.stage - 1, num_micro)
+        inputs, outputs, sends = {}, {}, []
+        total_loss = 0.0
+        device = next(self.parameters()).device
+        autocast = torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+        def forward(i):
+            nonlocal total_loss
+            in_idx, targets, *doc_ids = batches[i]
+            x = None
+            if not self.first:
+                x = self.hidden_buffer(in_idx)
+                dist.recv(x, self.ranks[self.stage - 1], group=self.group)
+                x.requires_grad_()
+            start = self.timer(device)
+            with autocast:
+                out = self.stage_forward(x, in_idx, targets, doc_ids=doc_ids[0] if doc_ids else None)
+            if self.last:
+                out = out / num_micro
+                total_loss += out.detach()
+            self.compute_time += self.timer(device) - start
+            if not self.last:
+                out_data = out.detach().contiguous()
+                sends.append((dist.isend(out_data, self.ranks[self.stage + 1], group=self.group), out_data))
+            inputs[i], outputs[i] = x, out
+
+        def backward(i):
+            x, out = inputs.pop(i), outputs.pop(i)
+            grad = None
+            if not self.last:
+                grad = torch.empty_like(out)
+                dist.recv(grad, self.ranks[self.stage + 1], group=self.group)
+            start = self.timer(device)
+            torch.autograd.backward(out, grad)
+            self.compute_time += self.timer(device) - start
+            if not self.first:
+                sends.append((dist.isend(x.grad, self.ranks[self.stage - 1], group=self.group), x.grad))
+
+        for i in range(warmup):
+            forward(i)
+        for i in range(num_micro - warmup):
+            forward(i + warmup)
+            backward(i)
+        for i in range(num_micro - warmup, num_micro):
+            backward(i)
+        for work, _ in sends:
+            work.wait()
+
+        self.average_gradients()
+        self.step_time += time.perf_counter() - step_start
+        return total_loss if self.last else None
+
+    @staticmethod
+    def timer(device):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)   # Kernels run asynchronously, time them to the end
+        return time.perf_counter()
+
+    def average_gradients(self):
+        # One all-reduce of all gradients of the stage over its data parallel group
+        world_size = dist.get_world_size(self.dp_group)
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        if world_size == 1 or not grads:
+            return
+        flat = torch.cat([g.flatten() for g in grads])
+        dist.all_reduce(flat, group=self.dp_group)
+        flat /= world_size
+        for g, part in zip(grads, flat.split([g.numel() for g in grads])):
+            g.copy_(part.view_as(g))
+
+    def clip_grad_norm_(self, max_norm):
+        # torch.nn.utils.clip_grad_norm_ with the norm of the gradients of all stages
+        grads = [p.grad for p in self.parameters() if p.grad is not None]
+        total = torch.zeros((), device=next(self.parameters()).device)
+        for g in grads:
+            total += g.float().square().sum()
+        dist.all_reduce(total, group=self.group)
+        total_norm = total.sqrt()
+        clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+        for g in grads:
+            g.mul_(clip_coef.to(g.dtype))
+        return total_norm
+
+    def stats(self, steps):
+        # (forward+backward seconds per step of every stage, bubble fraction) since the last call.
+        # The bubble is the share of the step the stages spent waiting. Collective over the group
+        times = [None] * self.num_stages
+        dist.all_gather_object(times, (self.compute_time / steps, self.step_time / steps), group=self.group)
+        self.compute_time = self.step_time = 0.0
+        compute = [c for c, _ in times]
+        step_time = max(t for _, t in times)
+        return compute, 1.0 - sum(compute) / (self.num_stages * step_time) if step_time else 0.0
+
+    def gather_state_dict(self, state_dict):
+        # State dict of the full model on rank 0, with the keys of the unsplit model, None on the
+        # other ranks. Only the pipeline of rank 0 takes part, the others hold the same weights
+        if 0 not in self.ranks:
+            return None
+        parts = [None] * self.num_stages if self.first else None
+        dist.gather_object({k: v.cpu() for k, v in state_dict.items()}, parts, dst=self.ranks[0], group=self.group)
+        return {k: v for part in parts for k, v in part.items()} if self.first else None
+
+    def stage_state_dict(self, state_dict):
+        # The part of a full state dict that belongs to this stage
+        own = self.state_dict().keys()
+        return {k: v for k, v in state_dict.items() if k in own}
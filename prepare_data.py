@@ -0,0 +1,722 @@
+import argparse
+import bisect
+import fcntl
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import threading
+import time
+import zlib
+
+import numpy as np
+import tiktoken
+import torch
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+from torch.utils.data.distributed import DistributedSampler
+
+
+# Token shard layout (little endian):
+#   header : 256 x int32 -> [magic, version, num_tokens, 0, ...]
+#   body   : num_tokens x uint16 token ids
+# The gpt2 vocabulary (50257 ids) fits in uint16, so a shard is 2 bytes per token.
+SHARD_MAGIC = 20240520
+SHARD_VERSION = 1
+HEADER_INTS = 256
+HEADER_BYTES = HEADER_INTS * 4
+SHARD_SIZE = 100_000_000  # Tokens per shard (~200 MB on disk)
+CHUNK_CHARS = 1_000_000   # Characters per tokenizer job
+EOT = "<|endoftext|>"
+EOT_ID = 50256            # gpt2 id of <|endoftext|>
+TOKENIZER = "gpt2"
+SPECIAL_TOKENS = {EOT}    # Special tokens allowed in the corpus text
+HASH_INDEX = "file_hashes.json"   # In the token cache: (size, mtime_ns) and sha256 of the hashed corpora
+
+
+def shard_path(data_dir, split, index):
+    return os.path.join(data_dir, f"{split}_{index:06d}.bin")
+
+
+def list_shards(data_dir, split):
+    return sorted(glob.glob(os.path.join(data_dir, f"{split}_*.bin")))
+
+
+def write_shard(file_path, token_ids):
+    tokens = np.asarray(token_ids)
+    assert tokens.size == 0 or (0 <= tokens.min() and tokens.max() < 2**16), "token ids do not fit in uint16"
+    header = np.zeros(HEADER_INTS, dtype=np.int32)
+    header[0] = SHARD_MAGIC
+    header[1] = SHARD_VERSION
+    header[2] = tokens.size
+
+    # Write to a temporary file first so a crash never leaves a half written shard behind
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(tokens.astype(np.uint16).tobytes())
+    os.replace(tmp_path, file_path)
+
+
+def read_shard_header(file_path):
+    header = np.fromfile(file_path, dtype=np.int32, count=HEADER_INTS)
+    assert header[0] == SHARD_MAGIC, f"{file_path} is not a token shard"
+    assert header[1] == SHARD_VERSION, f"unsupported shard version {header[1]} in {file_path}"
+    return int(header[2])
+
+
+def load_shard(file_path):
+    # Memory map the token ids, nothing is read until a window is sliced
+    num_tokens = read_shard_header(file_path)
+    return np.memmap(file_path, dtype=np.uint16, mode="r", offset=HEADER_BYTES, shape=(num_tokens,))
+
+
+class ShardWriter:
+    # Buffers token ids and flushes them into fixed size shards: {split}_000000.bin, {split}_000001.bin, ...
+    def __init__(self, data_dir, split, shard_size=SHARD_SIZE):
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.split = split
+        self.shard_size = shard_size
+        self.buffer = np.empty(shard_size, dtype=np.uint16)
+        self.fill = 0
+        self.shard_index = 0
+        self.num_tokens = 0
+
+        # Remove stale shards of a previous run so the split never mixes two corpora
+        for path in list_shards(data_dir, split):
+            os.remove(path)
+
+    def write(self, token_ids):
+        token_ids = np.asarray(token_ids, dtype=np.uint16)
+        while len(token_ids) > 0:
+            n = min(self.shard_size - self.fill, len(token_ids))
+            self.buffer[self.fill:self.fill + n] = token_ids[:n]
+            self.fill += n
+            token_ids = token_ids[n:]
+            if self.fill == self.shard_size:
+                self.flush()
+
+    def flush(self):
+        if self.fill == 0:
+            return
+        write_shard(shard_path(self.data_dir, self.split, self.shard_index), self.buffer[:self.fill])
+        self.num_tokens += self.fill
+        self.shard_index += 1
+        self.fill = 0
+
+    def close(self):
+        self.flush()
+        return self.num_tokens
+
+
+class TokenStream:
+    # The shards of a split as one continuous token stream. Supports len() and stream[start:end]
+    # like a numpy array, the shards are memory mapped on first use.
+    def __init__(self, data_dir, split):
+        self.paths = list_shards(data_dir, split)
+        assert len(self.paths) > 0, f"no {split} shards found in {data_dir}, run prepare_data.py first"
+
+        # Start offset of every shard in the concatenated stream
+        self.offsets = [0]
+        for path in self.paths:
+            self.offsets.append(self.offsets[-1] + read_shard_header(path))
+        self.num_tokens = self.offsets[-1]
+        self.shards = None
+
+    def __getstate__(self):
+        # Memmaps are reopened in every DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["shards"] = None
+        return state
+
+    def __len__(self):
+        return self.num_tokens
+
+    def open(self):
+        if self.shards is None:
+            self.shards = [load_shard(path) for path in self.paths]
+        return self.shards
+
+    def __getitem__(self, index):
+        start, end, _ = index.indices(self.num_tokens)
+        shards = self.open()
+        i = bisect.bisect_right(self.offsets, start) - 1
+        local_start = start - self.offsets[i]
+        local_end = end - self.offsets[i]
+        if local_end <= len(shards[i]):
+            return shards[i][local_start:local_end]   # View into the memmap, no copy
+
+        # Slice crosses a shard boundary
+        pieces = []
+        while start < end:
+            i = bisect.bisect_right(self.offsets, start) - 1
+            stop = min(end, self.offsets[i + 1])
+            pieces.append(shards[i][start - self.offsets[i]:stop - self.offsets[i]])
+            start = stop
+        return np.concatenate(pieces)
+
+    def find(self, token_id):
+        # Positions of every occurrence of token_id, read one shard at a time
+        return np.concatenate([np.flatnonzero(shard == token_id) + offset
+                               for shard, offset in zip(self.open(), self.offsets)])
+
+
+class MemmapTokenDataset(Dataset):
+    # Drop-in replacement for GPTDatasetV1 that reads windows lazily from the token shards.
+    # The shards are treated as one continuous token stream, so the windows are exactly the
+    # ones GPTDatasetV1 would build from the same text.
+    def __init__(self, data_dir, split, max_length, stride):
+        self.stream = TokenStream(data_dir, split)
+        self.max_length = max_length
+        self.stride = stride
+        self.num_windows = max(0, (len(self.stream) - max_length + stride - 1) // stride)
+
+    def __len__(self):
+        return self.num_windows
+
+    def __getitem__(self, idx):
+        start = idx * self.stride
+        chunk = torch.from_numpy(self.stream[start:start + self.max_length + 1].astype(np.int64))
+        return chunk[:-1], chunk[1:]
+
+
+class PackedTokenDataset(Dataset):
+    # Rows of max_length tokens filled with whole documents (split at <|endoftext|>, which stays
+    # at the end of its document) instead of a sliding window over the stream. Documents longer
+    # than a row are cut into pieces of max_length tokens. The pieces are packed best fit
+    # decreasing: longest first, each into the fullest row that still has room.
+    # Every item is (input_ids, target_ids, doc_ids):
+    #   - doc_ids numbers the pieces of the row 0, 1, 2, ...; the padding at the end gets its own id.
+    #     GPTModel only attends within a document and restarts the positions for each one.
+    #   - the target of the last token of a document and of the padding is -100 (ignored by the loss)
+    # tokens is a numpy array of token ids or a TokenStream.
+    def __init__(self, tokens, max_length, eot_id=EOT_ID):
+        self.tokens = tokens
+        self.max_length = max_length
+        self.eot_id = eot_id
+
+        # Last token (inclusive) of every document
+        ends = tokens.find(eot_id) if isinstance(tokens, TokenStream) else np.flatnonzero(np.asarray(tokens) == eot_id)
+        if len(ends) == 0 or ends[-1] != len(tokens) - 1:
+            ends = np.append(ends, len(tokens) - 1)
+        starts = np.concatenate([[0], ends[:-1] + 1])
+
+        # Documents longer than a row are cut into max_length pieces (the targets still
+        # continue into the next piece, only the attention is cut)
+        pieces = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            for piece_start in range(start, end + 1, max_length):
+                pieces.append((piece_start, min(max_length, end + 1 - piece_start), end))
+        pieces.sort(key=lambda piece: -piece[1])
+
+        # free: sorted (room left, row) of the rows that are not full yet
+        rows, free = [], []
+        for piece in pieces:
+            length = piece[1]
+            i = bisect.bisect_left(free, (length, -1))
+            if i == len(free):
+                row = len(rows)
+                rows.append([])
+                room = max_length
+            else:
+                room, row = free.pop(i)
+            rows[row].append(piece)
+            if room > length:
+                bisect.insort(free, (room - length, row))
+        self.rows = rows
+        self.num_tokens = sum(piece[1] for piece in pieces)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def fill_ratio(self):
+        # Fraction of the row positions that hold tokens rather than padding
+        return self.num_tokens / max(1, len(self.rows) * self.max_length)
+
+    def __getitem__(self, idx):
+        input_ids = torch.full((self.max_length,), self.eot_id, dtype=torch.long)
+        target_ids = torch.full((self.max_length,), -100, dtype=torch.long)
+        doc_ids = torch.empty(self.max_length, dtype=torch.long)
+        pos = 0
+        for doc, (start, length, doc_end) in enumerate(self.rows[idx]):
+            # One token more than the piece for the targets, unless the piece ends its document
+            stop = min(start + length + 1, doc_end + 1)
+            chunk = torch.from_numpy(np.asarray(self.tokens[start:stop]).astype(np.int64))
+            input_ids[pos:pos + length] = chunk[:length]
+            target_ids[pos:pos + len(chunk) - 1] = chunk[1:]
+            doc_ids[pos:pos + length] = doc
+            pos += length
+        doc_ids[pos:] = len(self.rows[idx])
+        return input_ids, target_ids, doc_ids
+
+
+def in_val_split(doc_index, val_fraction):
+    # Deterministic per document: the same document of the same file always lands in the same split
+    return zlib.crc32(doc_index.to_bytes(8, "little")) / 2**32 < val_fraction
+
+
+class StreamingTextDataset(IterableDataset):
+    # Windows of max_length + 1 tokens from a text file that is never loaded as a whole: the file
+    # is read chunk_chars characters at a time, documents (text up to and including separator)
+    # are tokenized as their text comes in and leftover tokens carry over to the next window.
+    #   - split: every document goes to "train" or "val" by a hash of its index (in_val_split)
+    #   - sharding: the documents of a split are dealt round robin over the world_size x num_workers
+    #     (rank, DataLoader worker) shards, so no document is read by two of them
+    #   - length: every shard yields the same number of windows per epoch, estimated from the file
+    #     size and the characters per token of the first chunk (a shard that runs out early starts
+    #     over), so the DDP ranks always run the same number of steps
+    #   - epoch/offset/state_dict(): same resumable state as ResumableSampler, offset counts the
+    #     samples consumed by this rank; on resume the consumed windows are read again and skipped
+    def __init__(self, file_path, split, max_length, stride=None, batch_size=1, num_workers=0, rank=0, world_size=1,
+                 val_fraction=0.1, separator=EOT, chunk_chars=CHUNK_CHARS):
+        assert split in ("train", "val")
+        self.file_path = file_path
+        self.split = split
+        self.max_length = max_length
+        self.stride = stride or max_length
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.rank = rank
+        self.world_size = world_size
+        self.val_fraction = val_fraction
+        self.separator = separator
+        self.chunk_chars = chunk_chars
+        self.epoch = 0
+        self.offset = 0
+
+        # Windows per rank, rounded down to whole batches of every worker
+        with open(file_path, "r", encoding="utf-8") as f:
+            sample = f.read(chunk_chars)
+        chars_per_token = len(sample) / max(1, len(_encode_chunk(sample)))
+        fraction = val_fraction if split == "val" else 1 - val_fraction
+        total_windows = os.path.getsize(file_path) * fraction / chars_per_token / self.stride
+        per_step = self.batch_size * self.num_workers
+        self.num_samples = max(per_step, int(total_windows / world_size) // per_step * per_step)
+
+    def __len__(self):
+        return self.num_samples
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "offset": self.offset}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.offset = state["offset"]
+
+    def pieces(self):
+        # Yields (document index, text); a long document comes in several pieces, cut where the
+        # tokens do not change (split_text), and its last piece ends with the separator
+        doc_index = 0
+        buffer = ""
+        with open(self.file_path, "r", encoding="utf-8") as f:
+            while True:
+                chunk = f.read(self.chunk_chars)
+                buffer += chunk
+                while True:
+                    end = buffer.find(self.separator)
+                    if end == -1:
+                        break
+                    end += len(self.separator)
+                    yield doc_index, buffer[:end]
+                    doc_index += 1
+                    buffer = buffer[end:]
+                if not chunk:
+                    break
+                if len(buffer) > self.chunk_chars:
+                    *done, buffer = split_text(buffer, self.chunk_chars)
+                    for piece in done:
+                        yield doc_index, piece
+        if buffer:
+            yield doc_index, buffer
+
+    def windows(self, shard, num_shards):
+        tokens = np.empty(0, dtype=np.int64)
+        split_doc = -1         # Index of the current document among the documents of this split
+        last_doc = -1
+        for doc_index, text in self.pieces():
+            if doc_index != last_doc:
+                last_doc = doc_index
+                in_split = in_val_split(doc_index, self.val_fraction) == (self.split == "val")
+                if in_split:
+                    split_doc += 1
+            if not in_split or split_doc % num_shards != shard:
+                continue
+            tokens = np.concatenate([tokens, _encode_chunk(text).astype(np.int64)])
+            start = 0
+            while len(tokens) - start >= self.max_length + 1:
+                chunk = torch.from_numpy(tokens[start:start + self.max_length + 1].copy())
+                yield chunk[:-1], chunk[1:]
+                start += self.stride
+            tokens = tokens[start:]   # Leftover tokens continue in the next window
+
+    def __iter__(self):
+        worker = get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        num_workers = worker.num_workers if worker is not None else 1
+        assert num_workers == self.num_workers or (num_workers == 1 and self.num_workers == 1), \
+            "num_workers of the dataset and of the DataLoader differ"
+
+        # The DataLoader takes whole batches from the workers in turn, starting with worker 0. After
+        # resuming, worker 0 continues the shard whose batch would have come next, and so on
+        consumed_batches = self.offset // self.batch_size
+        shard_worker = (worker_id + consumed_batches) % num_workers
+        skip = (consumed_batches // num_workers + (shard_worker < consumed_batches % num_workers)) * self.batch_size
+        limit = self.num_samples // num_workers
+        shard = self.rank * num_workers + shard_worker
+        num_shards = self.world_size * num_workers
+
+        count = 0
+        while count < limit:
+            produced = 0
+            for window in self.windows(shard, num_shards):
+                if count >= limit:
+                    return
+                if count >= skip:
+                    yield window
+                count += 1
+                produced += 1
+            if produced == 0:
+                return   # This shard has no data at all
+
+
+class ResumableSampler(Sampler):
+    # The order of an epoch only depends on (seed, epoch), so (seed, epoch, offset)
+    # is enough to restore the exact position in the data stream
+    def __init__(self, data_source, shuffle=True, seed=123):
+        self.num_samples = len(data_source)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.offset = 0    # Samples of the current epoch already consumed
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_samples, generator=g)
+        else:
+            order = torch.arange(self.num_samples)
+        return iter(order[self.offset:].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "offset": self.offset}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.offset = state["offset"]
+
+
+class ResumableLoaderIterator:
+    # Keeps a single DataLoader iterator alive across training steps (instead of next(iter(loader))
+    # every micro step) and moves to the next epoch when it runs out
+    def __init__(self, data_loader):
+        self.data_loader = data_loader
+        # A streaming dataset keeps its position itself (same epoch/offset state as ResumableSampler)
+        self.sampler = data_loader.dataset if isinstance(data_loader.dataset, IterableDataset) else data_loader.sampler
+        self.iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.data_loader)
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.sampler.epoch += 1
+            self.sampler.offset = 0
+            self.iterator = iter(self.data_loader)
+            batch = next(self.iterator)
+        self.sampler.offset += len(batch[0])
+        return batch
+
+    def state_dict(self):
+        return self.sampler.state_dict()
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(state)
+        self.iterator = None
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    # DistributedSampler with the position state of ResumableSampler. The order of an epoch
+    # only depends on (seed, epoch), offset counts the samples of this rank already consumed
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=123):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.offset = 0
+
+    def __iter__(self):
+        return itertools.islice(super().__iter__(), self.offset, None)
+
+    def state_dict(self):
+        return {"seed": self.seed, "epoch": self.epoch, "offset": self.offset}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.epoch = state["epoch"]
+        self.offset = state["offset"]
+
+
+class Prefetcher:
+    # Pulls batches from source (a DataLoader or a ResumableLoaderIterator) in a background thread
+    # and keeps up to depth of them ready on device. On CUDA the batches are copied from pinned
+    # memory with non_blocking=True on a side stream, so the copies overlap with compute.
+    # wait_time adds up the time the training loop spent waiting for a batch. state_dict() is
+    # the source position after the last batch handed out, not after the last one prefetched.
+    def __init__(self, source, device, depth=2):
+        self.source = source
+        self.device = torch.device(device)
+        self.depth = depth
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        self.state = source.state_dict() if hasattr(source, "state_dict") else None
+        self.queue = None
+        self.thread = None
+        self.stop = threading.Event()
+        self.wait_time = 0.0
+
+    def __iter__(self):
+        return self
+
+    def worker(self, iterator, batches, stop):
+        try:
+            for batch in iterator:
+                event = None
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = [(t if t.is_pinned() else t.pin_memory()).to(self.device, non_blocking=True)
+                                 for t in batch]
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                else:
+                    batch = [t.to(self.device) for t in batch]
+                state = self.source.state_dict() if self.state is not None else None
+                if not self.put(batches, stop, (batch, event, state)):
+                    return
+            self.put(batches, stop, None)   # End of the source
+        except Exception as e:
+            self.put(batches, stop, e)
+
+    def put(self, batches, stop, item):
+        # Returns False when the prefetcher was closed while the queue was full
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __next__(self):
+        if self.thread is None:
+            self.queue = queue.Queue(self.depth)
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.worker, args=(iter(self.source), self.queue, self.stop),
+                                           daemon=True)
+            self.thread.start()
+
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+        if item is None:
+            self.thread = None
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.thread = None
+            raise item
+
+        batch, event, state = item
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            for t in batch:
+                t.record_stream(stream)   # Allocated on the side stream, used on this one
+        self.state = state
+        return batch
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def state_dict(self):
+        return self.state
+
+    def load_state_dict(self, state):
+        # Prefetched batches belong to the old position and are dropped
+        self.close()
+        self.source.load_state_dict(state)
+        self.state = state
+
+
+def split_text(text, chunk_chars=CHUNK_CHARS):
+    # Cut the text into chunks of about chunk_chars characters whose token ids, concatenated,
+    # are exactly tokenizer.encode(text). A cut is only made
+    #   - right before an <|endoftext|> (special tokens are always split out by tiktoken), or
+    #   - right after a "\n" that has a letter/digit on both sides: the gpt2 pre-tokenizer
+    #     always emits such a newline as its own piece, so no piece spans the cut.
+    start = 0
+    while len(text) - start > chunk_chars:
+        cut = None
+        pos = start + chunk_chars
+        while cut is None:
+            i = text.find("\n", pos)
+            j = text.find(EOT, pos)
+            if i == -1 and j == -1:
+                break
+            if j != -1 and (i == -1 or j <= i):
+                cut = j if j > start else None
+                pos = j + len(EOT)
+            else:
+                if text[i - 1].isalnum() and i + 1 < len(text) and text[i + 1].isalnum():
+                    cut = i + 1
+                pos = i + 1
+        if cut is None:
+            break
+        yield text[start:cut]
+        start = cut
+    yield text[start:]
+
+
+_worker_tokenizer = None
+
+
+def _encode_chunk(chunk):
+    global _worker_tokenizer
+    if _worker_tokenizer is None:
+        _worker_tokenizer = tiktoken.get_encoding(TOKENIZER)
+    return np.asarray(_worker_tokenizer.encode(chunk, allowed_special=SPECIAL_TOKENS), dtype=np.uint16)
+
+
+def encode_parallel(text, pool=None, chunk_chars=CHUNK_CHARS):
+    # Yields the token ids of text chunk by chunk, in order
+    chunks = split_text(text, chunk_chars)
+    if pool is None:
+        yield from map(_encode_chunk, chunks)
+    else:
+        yield from pool.imap(_encode_chunk, chunks)
+
+
+def prepare(input_path, data_dir, train_ratio=0.90, shard_size=SHARD_SIZE, num_workers=None):
+    num_workers = num_workers or os.cpu_count()
+
+    with open(input_path, "r", encoding="utf-8") as file:
+        text_data = file.read()
+
+    # Same character level split as main() in the training scripts
+    split_idx = int(train_ratio * len(text_data))
+    splits = {"train": text_data[:split_idx], "val": text_data[split_idx:]}
+
+    pool = mp.Pool(num_workers) if num_workers > 1 else None
+    try:
+        for split, text in splits.items():
+            start = time.time()
+            writer = ShardWriter(data_dir, split, shard_size)
+            for token_ids in encode_parallel(text, pool):
+                writer.write(token_ids)
+            num_tokens = writer.close()
+            elapsed = time.time() - start
+            print(f"{split}: {num_tokens} tokens in {writer.shard_index} shard(s), "
+                  f"{elapsed:.1f}s ({num_tokens / max(elapsed, 1e-9):,.0f} tokens/sec, {num_workers} worker(s))")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def file_sha256(file_path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cached_file_sha256(file_path, cache_dir):
+    # file_sha256, re-hashed only when the size or mtime of the file changed since the last time.
+    # Reading a multi-GB corpus in full would otherwise cost every start as long as the hash takes
+    index_path = os.path.join(cache_dir, HASH_INDEX)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    stat = os.stat(file_path)
+    source = os.path.abspath(file_path)
+    entry = index.get(source)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = file_sha256(file_path)
+    index[source] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"   # Ranks of a node may write it at the same time
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+    return digest
+
+
+def token_cache_key(file_path, train_ratio=0.90, cache_dir=None):
+    # Everything that changes the token ids of the shards: the corpus content, the tokenizer
+    # and its special tokens, the split and the shard format
+    key = {
+        "file_sha256": cached_file_sha256(file_path, cache_dir) if cache_dir else file_sha256(file_path),
+        "tokenizer": TOKENIZER,
+        "tiktoken": tiktoken.__version__,
+        "special_tokens": sorted(SPECIAL_TOKENS),
+        "train_ratio": train_ratio,
+        "shard_version": SHARD_VERSION,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32], key
+
+
+def cached_token_shards(input_path, cache_dir=".token_cache", train_ratio=0.90, num_workers=None):
+    # Returns a directory with the train/val shards of input_path, tokenizing it only if the
+    # cache has no entry for it yet. Processes sharing cache_dir (the DDP ranks of a node) take
+    # a file lock: the first one tokenizes, the others wait and then read the same shards.
+    key, meta = token_cache_key(input_path, train_ratio, cache_dir)
+    path = os.path.join(cache_dir, key)
+    meta_path = os.path.join(path, "meta.json")
+    if os.path.isfile(meta_path):
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.isfile(meta_path):
+                print(f"Token cache {path} was written by another process")
+                return path
+            print(f"Tokenizing {input_path} into the token cache {path}")
+            tmp_path = path + ".tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            prepare(input_path, tmp_path, train_ratio, num_workers=num_workers)
+            meta["source"] = os.path.abspath(input_path)
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump(meta, f, indent=1)
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize a text corpus into uint16 token shards")
+    parser.add_argument("--input", default="AllCombined.txt", help="Text corpus to tokenize")
+    parser.add_argument("--data-dir", default="data", help="Output directory for the shards")
+    parser.add_argument("--train-ratio", type=float, default=0.90)
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Tokens per shard")
+    parser.add_argument("--workers", type=int, default=None, help="Tokenizer processes (default: all cores, 1 = single process)")
+    args = parser.parse_args()
+
+    prepare(args.input, args.data_dir, args.train_ratio, args.shard_size, args.workers)
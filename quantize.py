@@ -0,0 +1,135 @@
+import argparse
+import math
+import time
+
+import tiktoken
+import torch
+import torch.nn as nn
+
+from SingleGPU_PreTraining import (GPT_CONFIG_124M, GPTModel, calc_loss_loader, create_dataloader_from_shards,
+                                   create_dataloader_v1, generate_text_cached, list_shards, load_model_weights)
+
+
+class Int8Linear(nn.Module):
+    # Linear layer with int8 weights and one fp32 scale per output channel (symmetric).
+    # On CPU the activations are quantized per row on the fly and multiplied with an
+    # int8 x int8 -> int32 matmul, elsewhere the weights are dequantized for F.linear.
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(out_features))
+        if bias:
+            self.register_buffer("bias", torch.zeros(out_features))
+        else:
+            self.bias = None
+
+    @classmethod
+    def from_float(cls, linear):
+        layer = cls(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        layer.weight.copy_(torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8))
+        layer.scale.copy_(scale)
+        if linear.bias is not None:
+            layer.bias.copy_(linear.bias.detach().float())
+        return layer.to(linear.weight.device)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        if x.device.type == "cpu":
+            x_scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127
+            x_int8 = torch.round(x / x_scale).to(torch.int8)
+            out = torch._int_mm(x_int8, self.weight.t()) * (x_scale * self.scale)
+        else:
+            out = nn.functional.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias
+        return out.reshape(*shape[:-1], self.out_features).to(x.dtype)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+def quantize_model(model):
+    # Replace every nn.Linear (att.qkv, att.proj, ff.layers, out_head) by an Int8Linear in place.
+    # Embeddings and LayerNorms stay in fp32.
+    for name, module in list(model.named_modules()):
+        for child_name, child in module.named_children():
+            if isinstance(child, nn.Linear):
+                setattr(module, child_name, Int8Linear.from_float(child))
+    return model
+
+
+def save_quantized(model, file_path):
+    torch.save({'model_state_dict': model.state_dict(), 'quantization': "int8"}, file_path)
+
+
+def load_quantized(gpt_config, file_path):
+    # Build the int8 structure first, then fill it with the saved int8 weights and scales
+    model = quantize_model(GPTModel(gpt_config))
+    checkpoint = torch.load(file_path, map_location="cpu", weights_only=True)
+    assert checkpoint.get('quantization') == "int8", f"{file_path} is not an int8 checkpoint"
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.eval()
+
+
+def model_size_mb(model):
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 1024**2
+
+
+def val_loader_for(gpt_config, data_dir, text_path, batch_size):
+    if list_shards(data_dir, "val"):
+        return create_dataloader_from_shards(
+            data_dir, "val", batch_size=batch_size, max_length=gpt_config["context_length"],
+            stride=gpt_config["context_length"], drop_last=False, shuffle=False)
+
+    with open(text_path, "r", encoding="utf-8") as file:
+        text_data = file.read()
+    split_idx = int(0.90 * len(text_data))
+    return create_dataloader_v1(
+        text_data[split_idx:], batch_size=batch_size, max_length=gpt_config["context_length"],
+        stride=gpt_config["context_length"], drop_last=False, shuffle=False)
+
+
+def generation_speed(model, max_new_tokens=64):
+    idx = torch.zeros(1, 1, dtype=torch.long)
+    start = time.perf_counter()
+    generate_text_cached(model, idx, max_new_tokens, model.pos_emb.weight.shape[0])
+    return max_new_tokens / (time.perf_counter() - start)
+
+
+def compare(fp32_model, int8_model, val_loader, eval_batches):
+    device = torch.device("cpu")
+    with torch.inference_mode():
+        fp32_loss = calc_loss_loader(val_loader, fp32_model, device, num_batches=eval_batches)
+        int8_loss = calc_loss_loader(val_loader, int8_model, device, num_batches=eval_batches)
+        fp32_speed = generation_speed(fp32_model)
+        int8_speed = generation_speed(int8_model)
+
+    print(f"{'':6}{'size (MB)':>12}{'val ppl':>12}{'tokens/sec':>12}")
+    print(f"{'fp32':6}{model_size_mb(fp32_model):12.1f}{math.exp(fp32_loss):12.3f}{fp32_speed:12.1f}")
+    print(f"{'int8':6}{model_size_mb(int8_model):12.1f}{math.exp(int8_loss):12.3f}{int8_speed:12.1f}")
+    print(f"Perplexity delta = {math.exp(int8_loss) - math.exp(fp32_loss):+.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize the Linear layers of a GPTModel checkpoint to int8 for CPU inference")
+    parser.add_argument("--checkpoint", default="checkpoint.pt")
+    parser.add_argument("--out", default="checkpoint_int8.pt")
+    parser.add_argument("--data-dir", default="data", help="Token shards for the perplexity comparison")
+    parser.add_argument("--text", default="AllCombined.txt", help="Corpus used when there are no shards")
+    parser.add_argument("--eval-batches", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=2)
+    args = parser.parse_args()
+
+    fp32_model = load_model_weights(GPTModel(GPT_CONFIG_124M), args.checkpoint).eval()
+    int8_model = quantize_model(load_model_weights(GPTModel(GPT_CONFIG_124M), args.checkpoint)).eval()
+    save_quantized(int8_model, args.out)
+    print(f"Saved int8 checkpoint to {args.out}")
+
+    val_loader = val_loader_for(GPT_CONFIG_124M, args.data_dir, args.text, args.batch_size)
+    compare(fp32_model, load_quantized(GPT_CONFIG_124M, args.out), val_loader, args.eval_batches)
@@ -0,0 +1,182 @@
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+# Megatron style tensor parallelism for GPTModel. Inside a tensor parallel group every rank keeps
+# 1/tp of the heads of each MultiHeadAttention and 1/tp of the hidden units of each FeedForward:
+#   att.qkv, ff.layers[0]    column parallel: the output features are split, the input is the full x
+#   att.proj, ff.layers[2]   row parallel: the input features are split, the partial outputs are
+#                            summed with an all-reduce
+# so every attention and feed-forward sublayer does one all-reduce in forward and one (for the
+# input gradient of the column parallel layer) in backward. Embeddings, LayerNorms and out_head
+# stay replicated. All ranks of a group must see the same batches and draw the same dropout masks.
+# Like quantize_model: build the full model with the same seed on every rank, then
+# tensor_parallel(model, tp_group) replaces the layers in place.
+
+
+def init_groups(tp_size):
+    # world = data parallel x tensor parallel. Ranks k*tp_size .. (k+1)*tp_size-1 form a tensor
+    # parallel group (neighbouring ranks, on one node with torchrun), the ranks with the same
+    # position in their group form a data parallel group. Every rank has to create every group.
+    # Returns (tp_group, dp_group), tp_group is None without tensor parallelism
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    assert world_size % tp_size == 0, f"world size {world_size} is not a multiple of tensor_parallel={tp_size}"
+    if tp_size == 1:
+        return None, dist.group.WORLD
+    tp_group = dp_group = None
+    for start in range(0, world_size, tp_size):
+        group = dist.new_group(list(range(start, start + tp_size)))
+        if start <= rank < start + tp_size:
+            tp_group = group
+    for offset in range(tp_size):
+        group = dist.new_group(list(range(offset, world_size, tp_size)))
+        if rank % tp_size == offset:
+            dp_group = group
+    return tp_group, dp_group
+
+
+class CopyToTensorParallel(torch.autograd.Function):
+    # Identity in forward, all-reduce of the input gradient in backward
+    @staticmethod
+    def forward(ctx, x, group):
+        ctx.group = group
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous().clone()
+        dist.all_reduce(grad, group=ctx.group)
+        return grad, None
+
+
+class ReduceFromTensorParallel(torch.autograd.Function):
+    # All-reduce in forward, identity in backward
+    @staticmethod
+    def forward(ctx, x, group):
+        x = x.contiguous().clone()
+        dist.all_reduce(x, group=group)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad, None
+
+
+class ColumnParallelLinear(nn.Module):
+    # Output features indices[rank] of a Linear layer. indices holds the ones of every rank of
+    # the group, gather_state_dict uses them to rebuild the full weight
+    def __init__(self, linear, indices, group):
+        super().__init__()
+        self.group = group
+        self.indices = indices
+        index = indices[dist.get_rank(group)]
+        self.weight = nn.Parameter(linear.weight.detach()[index].clone())
+        self.weight.tensor_parallel = True
+        self.bias = None
+        if linear.bias is not None:
+            self.bias = nn.Parameter(linear.bias.detach()[index].clone())
+            self.bias.tensor_parallel = True
+
+    def forward(self, x):
+        return nn.functional.linear(CopyToTensorParallel.apply(x, self.group), self.weight, self.bias)
+
+    def sharded(self):
+        # (parameter name, dim it is split along)
+        return [("weight", 0)] + ([("bias", 0)] if self.bias is not None else [])
+
+
+class RowParallelLinear(nn.Module):
+    # Input features indices[rank] of a Linear layer. The bias is replicated and added once,
+    # after the partial outputs are summed
+    def __init__(self, linear, indices, group):
+        super().__init__()
+        self.group = group
+        self.indices = indices
+        index = indices[dist.get_rank(group)]
+        self.weight = nn.Parameter(linear.weight.detach()[:, index].clone())
+        self.weight.tensor_parallel = True
+        self.bias = nn.Parameter(linear.bias.detach().clone()) if linear.bias is not None else None
+
+    def forward(self, x):
+        out = ReduceFromTensorParallel.apply(nn.functional.linear(x, self.weight), self.group)
+        return out + self.bias if self.bias is not None else out
+
+    def sharded(self):
+        return [("weight", 1)]
+
+
+def tensor_parallel(model, group):
+    # Splits the heads and the feed-forward hidden units of every block of a GPTModel over group
+    size = dist.get_world_size(group)
+    for block in model.trf_blocks:
+        att = block.att
+        assert att.num_heads % size == 0, f"{att.num_heads} heads can't be split over {size} ranks"
+        local_dim = att.d_out // size
+        heads = [torch.arange(r * local_dim, (r + 1) * local_dim) for r in range(size)]
+        # qkv rows are [queries; keys; values], each ordered by head
+        qkv = [torch.cat([part * att.d_out + h for part in range(3)]) for h in heads]
+        att.qkv = ColumnParallelLinear(att.qkv, qkv, group)
+        att.proj = RowParallelLinear(att.proj, heads, group)
+        att.num_heads //= size
+        att.d_out = local_dim
+
+        ff = block.ff.layers
+        hidden = ff[0].out_features // size
+        units = [torch.arange(r * hidden, (r + 1) * hidden) for r in range(size)]
+        ff[0] = ColumnParallelLinear(ff[0], units, group)
+        ff[2] = RowParallelLinear(ff[2], units, group)
+    return model
+
+
+def parallel_layers(model):
+    # (state dict prefix, layer) of every sharded layer, model can be wrapped in DDP/torch.compile
+    return [(name + ".", module) for name, module in model.named_modules()
+            if isinstance(module, (ColumnParallelLinear, RowParallelLinear))]
+
+
+def gather_state_dict(model, state_dict):
+    # Full (unsharded) weights in the state dict of a tensor parallel model, the same as for the
+    # model without tensor parallelism. Collective, every rank of the group has to call it
+    state_dict = dict(state_dict)
+    for prefix, layer in parallel_layers(model):
+        for name, dim in layer.sharded():
+            local = state_dict[prefix + name].contiguous()
+            parts = [torch.empty_like(local) for _ in layer.indices]
+            dist.all_gather(parts, local, group=layer.group)
+            shape = list(local.shape)
+            shape[dim] = sum(len(index) for index in layer.indices)
+            full = local.new_empty(shape)
+            for index, part in zip(layer.indices, parts):
+                full.index_copy_(dim, index.to(full.device), part)
+            state_dict[prefix + name] = full
+    return state_dict
+
+
+def shard_state_dict(model, state_dict):
+    # Part of a full state dict that belongs to this rank of a tensor parallel model
+    state_dict = dict(state_dict)
+    for prefix, layer in parallel_layers(model):
+        index = layer.indices[dist.get_rank(layer.group)]
+        for name, dim in layer.sharded():
+            full = state_dict[prefix + name]
+            state_dict[prefix + name] = full.index_select(dim, index.to(full.device))
+    return state_dict
+
+
+def clip_grad_norm_(parameters, max_norm, group):
+    # torch.nn.utils.clip_grad_norm_ with the norm of the full model: the squared gradients of
+    # the sharded parameters are summed over the group, the replicated ones are counted once
+    grads = [(p.grad, getattr(p, "tensor_parallel", False)) for p in parameters if p.grad is not None]
+    sharded = torch.zeros((), device=grads[0][0].device)
+    replicated = torch.zeros((), device=grads[0][0].device)
+    for g, split in grads:
+        if split:
+            sharded += g.float().square().sum()
+        else:
+            replicated += g.float().square().sum()
+    dist.all_reduce(sharded, group=group)
+    total_norm = (sharded + replicated).sqrt()
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for g, _ in grads:
+        g.mul_(clip_coef.to(g.dtype))
+    return total_norm